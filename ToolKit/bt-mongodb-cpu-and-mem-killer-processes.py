@@ -1,6 +1,12 @@
 import argparse
+import heapq
+import re
+import shutil
+import sys
+import time
+from datetime import datetime
 from pymongo import MongoClient
-from pymongo.errors import OperationFailure
+from pymongo.errors import OperationFailure, PyMongoError
 
 def get_resource_intensive_operations(client, check_mem, check_cpu, ignore_dbs, order_by, limit):
     admin_db = client.admin
@@ -29,6 +35,178 @@ def get_resource_intensive_operations(client, check_mem, check_cpu, ignore_dbs,
 
     return ops
 
+# Counters $currentOp exposes per operation, cpuNanos only on Linux with recent servers
+COUNTERS = {
+    'cpuNanos': ('cpuNanos',),
+    'docsExamined': ('docsExamined',),
+    'keysExamined': ('keysExamined',),
+    'bytesRead': ('storage', 'data', 'bytesRead'),
+    'numYields': ('numYields',)
+}
+REPORT_FIELDS = ['opid', 'ns', 'op', 'desc', 'client', 'appName', 'planSummary', 'secs_running', 'microsecs_running']
+
+def build_sampling_pipeline(ignore_dbs):
+    match = {'active': True, 'op': {'$ne': 'none'}}
+    if ignore_dbs:
+        match['ns'] = {'$not': re.compile('^(?:' + '|'.join(re.escape(db) for db in ignore_dbs) + r')(?:\.|$)')}
+    projection = {field: 1 for field in REPORT_FIELDS}
+    projection.update({'.'.join(path): 1 for path in COUNTERS.values()})
+    return [
+        {'$currentOp': {'allUsers': True, 'idleConnections': False}},
+        {'$match': match},
+        {'$project': projection}
+    ]
+
+def read_counters(op):
+    counters = {}
+    for name, path in COUNTERS.items():
+        value = op
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, (int, float)):
+            counters[name] = value
+    return counters
+
+def sample_operations(client, ignore_dbs, samples, interval):
+    # Keeps the first and last sighting of every opid, memory grows with concurrent ops, not with samples
+    first, last = {}, {}
+    pipeline = build_sampling_pipeline(ignore_dbs)
+    for sample in range(samples):
+        if sample:
+            time.sleep(interval)
+        now = time.monotonic()
+        for op in client.admin.aggregate(pipeline, batchSize=500):
+            seen = (now, read_counters(op), op)
+            first.setdefault(op['opid'], seen)
+            last[op['opid']] = seen
+    return first, last
+
+def operation_rates(first, last):
+    rates = []
+    for opid, (end, end_counters, op) in last.items():
+        start, start_counters, _ = first[opid]
+        if end > start:
+            elapsed = end - start
+            # Counters only grow while an op runs, a missing start value means the op began between samples
+            deltas = {name: value - start_counters.get(name, 0) for name, value in end_counters.items()}
+        else:
+            # Seen in a single sample, fall back to the average since the op started
+            elapsed = max(op.get('microsecs_running', 0) / 1e6, 1e-3)
+            deltas = end_counters
+        rates.append((op, {name: value / elapsed for name, value in deltas.items()}))
+    return rates
+
+def rank_key(check):
+    # cpuNanos is the real CPU answer when the server reports it, work done is the proxy otherwise
+    if check == 'cpu':
+        return lambda item: (item[1].get('cpuNanos', 0), item[1].get('docsExamined', 0) + item[1].get('keysExamined', 0))
+    return lambda item: (item[1].get('bytesRead', 0), item[1].get('docsExamined', 0))
+
+def top_consumers(rates, check, limit, order_by):
+    select = heapq.nlargest if order_by == 'desc' else heapq.nsmallest
+    return select(limit, rates, key=rank_key(check))
+
+def print_consumers(title, consumers):
+    print(f"\n{title}:")
+    for op, rate in consumers:
+        cpu = f"{rate['cpuNanos'] / 1e6:.1f}" if 'cpuNanos' in rate else 'n/a'
+        print(f"opid: {op.get('opid')}  ns: {op.get('ns')}  op: {op.get('op')}  secs_running: {op.get('secs_running')}  cpu ms/s: {cpu}  "
+              f"docs/s: {rate.get('docsExamined', 0):.0f}  keys/s: {rate.get('keysExamined', 0):.0f}  bytes read/s: {rate.get('bytesRead', 0):.0f}  "
+              f"yields/s: {rate.get('numYields', 0):.1f}  plan: {op.get('planSummary', '')}  app: {op.get('appName', '')}  client: {op.get('client', '')}")
+
+def client_host(op):
+    return (op.get('client') or '').rsplit(':', 1)[0]
+
+def group_operations(ops, previous, elapsed):
+    # One pass over the ops, counters are diffed against the previous frame by opid
+    groups = {}
+    current = {}
+    for op in ops:
+        counters = read_counters(op)
+        current[op['opid']] = (op.get('ns', ''), op.get('op', ''), client_host(op), counters)
+        key = current[op['opid']][:3]
+        group = groups.setdefault(key, {'ops': 0, 'new': 0, 'finished': 0, 'max_secs': 0, 'rates': {}})
+        group['ops'] += 1
+        group['max_secs'] = max(group['max_secs'], op.get('secs_running', 0))
+        if op['opid'] in previous:
+            before = previous[op['opid']][3]
+            for name, value in counters.items():
+                group['rates'][name] = group['rates'].get(name, 0) + max(value - before.get(name, 0), 0) / elapsed
+        else:
+            group['new'] += 1
+
+    for opid, (ns, op_type, host, _) in previous.items():
+        if opid not in current:
+            group = groups.setdefault((ns, op_type, host), {'ops': 0, 'new': 0, 'finished': 0, 'max_secs': 0, 'rates': {}})
+            group['finished'] += 1
+    return groups, current
+
+def live_rows(groups, check, width):
+    if check == 'cpu':
+        sort_key = lambda item: (item[1]['rates'].get('cpuNanos', 0), item[1]['rates'].get('docsExamined', 0), item[1]['ops'])
+    else:
+        sort_key = lambda item: (item[1]['rates'].get('bytesRead', 0), item[1]['rates'].get('docsExamined', 0), item[1]['ops'])
+    rows = []
+    for (ns, op_type, host), group in sorted(groups.items(), key=sort_key, reverse=True):
+        rates = group['rates']
+        line = (f"{group['ops']:>5} {'+' + str(group['new']) if group['new'] else '':>5} {'-' + str(group['finished']) if group['finished'] else '':>5} "
+                f"{group['max_secs']:>8} {rates.get('cpuNanos', 0) / 1e6:>9.1f} {rates.get('docsExamined', 0):>10.0f} {rates.get('keysExamined', 0):>10.0f} "
+                f"{rates.get('bytesRead', 0):>12.0f}  {op_type:<10} {host:<16} {ns}")[:width]
+        # New ops in green, groups that only finished since the last frame in dim red
+        if group['new']:
+            line = f"\x1b[32m{line}\x1b[0m"
+        elif not group['ops']:
+            line = f"\x1b[2;31m{line}\x1b[0m"
+        rows.append(line)
+    return rows
+
+def render_frame(previous_lines, lines, stream):
+    # Only rows that differ from the previous frame are rewritten
+    out = []
+    for row, line in enumerate(lines):
+        if row >= len(previous_lines) or previous_lines[row] != line:
+            out.append(f"\x1b[{row + 1};1H{line}\x1b[K")
+    for row in range(len(lines), len(previous_lines)):
+        out.append(f"\x1b[{row + 1};1H\x1b[K")
+    stream.write(''.join(out))
+    stream.flush()
+
+def live_view(client, ignore_dbs, check, interval, stream=sys.stdout):
+    pipeline = build_sampling_pipeline(ignore_dbs)
+    previous = {}
+    previous_lines = []
+    last_poll = time.monotonic()
+    stream.write("\x1b[?25l\x1b[2J")
+    try:
+        while True:
+            started = time.monotonic()
+            width, height = shutil.get_terminal_size()
+            try:
+                groups, previous = group_operations(client.admin.aggregate(pipeline, batchSize=1000), previous, max(started - last_poll, 1e-3))
+            except PyMongoError as e:
+                # Keep the last rows on screen and retry, the next successful poll covers the whole gap
+                lines = [f"{datetime.now():%H:%M:%S}  $currentOp failed, retrying in {interval:g}s: {e}"[:width]] + previous_lines[1:]
+                render_frame(previous_lines, lines, stream)
+                previous_lines = lines
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+                continue
+            last_poll = started
+            total = sum(group['ops'] for group in groups.values())
+            new = sum(group['new'] for group in groups.values())
+            finished = sum(group['finished'] for group in groups.values())
+            lines = [
+                f"{datetime.now():%H:%M:%S}  active ops: {total}  new: {new}  finished: {finished}  groups: {len(groups)}  "
+                f"refresh: {(time.monotonic() - started) * 1000:.0f} ms  sorted by {check}"[:width],
+                f"{'OPS':>5} {'NEW':>5} {'DONE':>5} {'MAX SECS':>8} {'CPU ms/s':>9} {'DOCS/s':>10} {'KEYS/s':>10} {'BYTES/s':>12}  {'OP':<10} {'CLIENT':<16} NS"[:width]
+            ]
+            lines.extend(live_rows(groups, check, width)[:max(height - len(lines) - 1, 0)])
+            render_frame(previous_lines, lines, stream)
+            previous_lines = lines
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+    finally:
+        stream.write(f"\x1b[{len(previous_lines) + 1};1H\x1b[?25h\n")
+        stream.flush()
+
 def main():
     parser = argparse.ArgumentParser(description='Check MongoDB running operations consuming most CPU and RAM.')
     parser.add_argument('--host', default='localhost', help='MongoDB host (default: localhost)')
@@ -37,14 +215,18 @@ def main():
     parser.add_argument('--password', default=None, help='MongoDB password (default: None)')
     parser.add_argument('--check', choices=['mem', 'cpu'], help='Check memory or CPU usage')
     parser.add_argument('--check-both', action='store_true', help='Check both memory and CPU usage')
-    parser.add_argument('--order-by', choices=['asc', 'desc'], default='desc', help='Order results by ascending or descending secs_running (default: descending)')
+    parser.add_argument('--order-by', choices=['asc', 'desc'], default='desc', help='Order results by ascending or descending secs_running, or by rate per second with --samples 2 or more (default: descending)')
     parser.add_argument('--limit', type=int, help='Limit the number of results')
     parser.add_argument('--all-databases', action='store_true', help='Include operations from all databases')
     parser.add_argument('--ignore-databases', nargs='*', default=[], help='Databases to ignore when using --all-databases')
+    parser.add_argument('--samples', type=int, default=1, help='Number of $currentOp samples used to rank operations by counter deltas per second, 1 prints a single snapshot (default: 1)')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between samples (default: 1.0)')
+    parser.add_argument('--live', action='store_true', help='Interactive view refreshing active ops grouped by namespace, op and client every --refresh seconds until interrupted')
+    parser.add_argument('--refresh', type=float, default=2.0, help='Seconds between refreshes with --live (default: 2.0)')
 
     args = parser.parse_args()
 
-    if not args.check and not args.check_both:
+    if not args.check and not args.check_both and not args.live:
         print("You must specify either --check or --check-both.")
         return
 
@@ -58,10 +240,37 @@ def main():
     check_mem = args.check in ['mem'] or args.check_both
     check_cpu = args.check in ['cpu'] or args.check_both
 
-    intensive_ops = get_resource_intensive_operations(client, check_mem, check_cpu, ignore_dbs, args.order_by, args.limit)
+    if args.live:
+        ignore_dbs = [db for item in ignore_dbs for db in item.split(',') if db]
+        try:
+            live_view(client, ignore_dbs, 'mem' if check_mem and not check_cpu else 'cpu', args.refresh)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.close()
+        return
+
+    if args.samples < 2:
+        intensive_ops = get_resource_intensive_operations(client, check_mem, check_cpu, ignore_dbs, args.order_by, args.limit)
+
+        for op in intensive_ops:
+            print(op)
+        return
 
-    for op in intensive_ops:
-        print(op)
+    ignore_dbs = [db for item in ignore_dbs for db in item.split(',') if db]
+    try:
+        first, last = sample_operations(client, ignore_dbs, args.samples, args.sample_interval)
+    except OperationFailure as e:
+        print(f"Failed to run $currentOp aggregation: {e}")
+        return
+    rates = operation_rates(first, last)
+    print(f"Sampled {len(last)} operations {args.samples} times over {(args.samples - 1) * args.sample_interval:.1f} seconds")
+    limit = args.limit or 10
+    rank = 'Top' if args.order_by == 'desc' else 'Least active'
+    if check_cpu:
+        print_consumers(f"{rank} {limit} CPU consumers per second", top_consumers(rates, 'cpu', limit, args.order_by))
+    if check_mem:
+        print_consumers(f"{rank} {limit} cache and memory consumers per second", top_consumers(rates, 'mem', limit, args.order_by))
 
 if __name__ == '__main__':
     main()
@@ -1,59 +1,288 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from pymongo import MongoClient
+from index_stats import fetch_all_nodes, get_node_clients, index_status, merge_index_stats
 
 def get_all_databases(client):
     return [db for db in client.list_database_names() if db not in ('admin', 'local', 'config')]
 
 def get_all_collections(db):
-    return db.list_collection_names()
+    # Views have no indexes of their own and fail $indexStats
+    return db.list_collection_names(filter={'type': 'collection'})
 
 def fetch_indexes(collection):
     return collection.index_information()
 
-def is_prefix(index1, index2):
-    keys1 = index1
-    keys2 = index2
-    if len(keys1) >= len(keys2):
+def plain_key_pattern(key):
+    # Only ascending/descending keys can be covered by a longer index, text, geo, hashed and wildcard keys are skipped
+    pattern = []
+    for field, direction in key:
+        if isinstance(direction, bool) or not isinstance(direction, (int, float)) or '$**' in field:
+            return None
+        pattern.append((field, 1 if direction > 0 else -1))
+    return tuple(pattern)
+
+def build_index_trie(patterns):
+    trie = {'children': {}, 'indexes': []}
+    for name, pattern in patterns.items():
+        node = trie
+        for key in pattern:
+            node = node['children'].setdefault(key, {'children': {}, 'indexes': []})
+        node['indexes'].append(name)
+    return trie
+
+def longer_indexes(node):
+    # Every index below a node has the node's path as a strict prefix
+    stack = list(node['children'].values())
+    while stack:
+        child = stack.pop()
+        yield from child['indexes']
+        stack.extend(child['children'].values())
+
+def covers_options(redundant, covering):
+    # Constraints and TTLs are behaviour, not just access paths
+    if redundant.get('unique') or 'expireAfterSeconds' in redundant:
+        return False
+    if covering.get('hidden'):
+        return False
+    if covering.get('sparse') and not redundant.get('sparse'):
+        return False
+    if 'partialFilterExpression' in covering and covering['partialFilterExpression'] != redundant.get('partialFilterExpression'):
+        return False
+    if covering.get('collation') != redundant.get('collation'):
         return False
-    for i in range(len(keys1)):
-        if keys1[i] != keys2[i]:
-            return False
     return True
 
-def check_duplicated_indexes(db, collection):
-    indexes = fetch_indexes(collection)
-    duplicates = []
-    index_names = list(indexes.keys())
+def find_duplicated_indexes(indexes):
+    patterns = {}
+    for name, info in indexes.items():
+        pattern = plain_key_pattern(info['key'])
+        if pattern is not None:
+            patterns[name] = pattern
+    trie = build_index_trie(patterns)
 
-    for i in range(len(index_names)):
-        for j in range(i + 1, len(index_names)):
-            idx1 = indexes[index_names[i]]['key']
-            idx2 = indexes[index_names[j]]['key']
-            if is_prefix(idx1, idx2):
-                duplicates.append((index_names[i], index_names[j]))
-            elif is_prefix(idx2, idx1):
-                duplicates.append((index_names[j], index_names[i]))
+    duplicates = []
+    for name, pattern in patterns.items():
+        if name == '_id_':
+            continue
+        # An index scanned backwards serves the fully reversed prefix as well
+        reversed_pattern = tuple((field, -direction) for field, direction in pattern)
+        covering = None
+        for candidate in (pattern, reversed_pattern):
+            node = trie
+            for key in candidate:
+                node = node['children'].get(key)
+                if node is None:
+                    break
+            if node is None:
+                continue
+            covering = next((other for other in longer_indexes(node) if covers_options(indexes[name], indexes[other])), None)
+            if covering:
+                break
+        if covering:
+            duplicates.append((name, covering))
 
     return duplicates
 
+def find_unused_indexes(index_stats):
+    return [index['name'] for index in index_stats if index.get('accesses', {}).get('ops', 0) == 0]
+
+def check_duplicated_indexes(db, collection):
+    return find_duplicated_indexes(fetch_indexes(collection))
+
 def check_unused_indexes(db, collection):
     try:
-        index_stats = collection.aggregate([{"$indexStats": {}}])
-        unused_indexes = []
-        for index in index_stats:
-            if index.get('accesses', {}).get('ops', 0) == 0:
-                unused_indexes.append(index['name'])
-        return unused_indexes
+        return find_unused_indexes(collection.aggregate([{"$indexStats": {}}]))
     except Exception as e:
         print(f"Error checking unused indexes: {e}")
         return []
 
+def indexes_from_stats(index_stats):
+    # $indexStats returns the full spec since 4.2, in the same shape index_information() uses for keys
+    indexes = {}
+    for index in index_stats:
+        if 'spec' not in index:
+            return None
+        indexes[index['name']] = dict(index['spec'], key=list(index['spec']['key'].items()))
+    return indexes
+
+def audit_collection(collection, check_duplicated, check_unused):
+    if not check_unused:
+        return check_duplicated_indexes(collection.database, collection), []
+
+    # A single $indexStats round-trip answers both checks
+    try:
+        index_stats = list(collection.aggregate([{"$indexStats": {}}]))
+    except Exception as e:
+        print(f"Error checking unused indexes: {e}")
+        index_stats = None
+
+    duplicates = []
+    if check_duplicated:
+        indexes = indexes_from_stats(index_stats) if index_stats is not None else None
+        if indexes is None:
+            indexes = fetch_indexes(collection)
+        duplicates = find_duplicated_indexes(indexes)
+
+    unused = find_unused_indexes(index_stats) if index_stats is not None else []
+    return duplicates, unused
+
+def audit_collection_all_nodes(collection, check_duplicated, node_clients, node_sets, node_pool, min_window):
+    duplicates = check_duplicated_indexes(collection.database, collection) if check_duplicated else []
+    node_stats = fetch_all_nodes(node_clients, node_pool, collection.database.name, collection.name)
+    merged = merge_index_stats(node_stats, node_sets)
+    status = {name: index_status(entry, min_window) for name, entry in merged.items()}
+    unused = [name for name in merged if status[name] == 'unused']
+    too_recent = [name for name in merged if status[name] == 'too recent']
+    unknown = [name for name in merged if status[name] == 'unknown']
+    unreachable = max((merged[name]['unreachable'] for name in unknown), default=0)
+    return duplicates, unused, too_recent, (unreachable, unknown)
+
+EQUALITY_OPERATORS = {'$eq', '$in', '$elemMatch'}
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$regex', '$options', '$exists', '$type', '$not', '$all', '$size', '$mod'}
+PROFILE_PROJECTION = {
+    'ns': 1, 'docsExamined': 1, 'nreturned': 1, 'nMatched': 1, 'ndeleted': 1,
+    'command.filter': 1, 'command.sort': 1, 'command.q': 1, 'command.query': 1, 'command.pipeline': 1
+}
+
+def workload_predicates(command):
+    # Only the first $match and a $sort right behind it can use an index in a pipeline
+    if 'pipeline' in command:
+        pipeline = command['pipeline'] or []
+        if not pipeline or '$match' not in pipeline[0]:
+            return None, None
+        sort = pipeline[1].get('$sort') if len(pipeline) > 1 else None
+        return pipeline[0]['$match'], sort
+    if 'q' in command:
+        return command['q'], None
+    if 'filter' in command:
+        return command['filter'], command.get('sort')
+    if 'query' in command:
+        return command['query'], command.get('sort')
+    return None, None
+
+def classify_predicate(filter_doc, equality, ranges):
+    for field, value in (filter_doc or {}).items():
+        if field == '$and':
+            for clause in value:
+                classify_predicate(clause, equality, ranges)
+        elif field.startswith('$'):
+            # $or, $expr, $text and friends need other index shapes than a single compound index
+            continue
+        elif isinstance(value, dict) and value and all(op.startswith('$') for op in value):
+            if set(value) <= EQUALITY_OPERATORS:
+                equality.add(field)
+            elif set(value) <= EQUALITY_OPERATORS | RANGE_OPERATORS:
+                ranges.add(field)
+        elif hasattr(value, 'pattern') and hasattr(value, 'flags'):
+            ranges.add(field)
+        else:
+            equality.add(field)
+
+def workload_shape(entry):
+    filter_doc, sort = workload_predicates(entry.get('command') or {})
+    if filter_doc is None and not sort:
+        return None
+    equality, ranges = set(), set()
+    classify_predicate(filter_doc, equality, ranges)
+    ranges -= equality
+    sort_fields = tuple((field, 1 if direction > 0 else -1) for field, direction in (sort or {}).items()
+                        if isinstance(direction, (int, float)) and field not in equality)
+    ranges -= {field for field, _ in sort_fields}
+    if not equality and not sort_fields and not ranges:
+        return None
+    return frozenset(equality), sort_fields, frozenset(ranges)
+
+def esr_key(shape):
+    equality, sort_fields, ranges = shape
+    return tuple([(field, 1) for field in sorted(equality)] + list(sort_fields) + [(field, 1) for field in sorted(ranges)])
+
+def build_prefix_lookup(indexes):
+    # Maps the set of the first k fields of every usable index to (pattern, k), so a shape's equality set is one dict hit
+    lookup = {}
+    for info in indexes.values():
+        if info.get('hidden') or 'partialFilterExpression' in info:
+            continue
+        pattern = plain_key_pattern(info['key'])
+        if pattern is None:
+            continue
+        for k in range(len(pattern) + 1):
+            lookup.setdefault(frozenset(field for field, _ in pattern[:k]), []).append((pattern, k))
+    return lookup
+
+def shape_served(lookup, shape):
+    equality, sort_fields, ranges = shape
+    reversed_sort = tuple((field, -direction) for field, direction in sort_fields)
+    for pattern, k in lookup.get(equality, []):
+        sort_end = k + len(sort_fields)
+        if pattern[k:sort_end] not in (sort_fields, reversed_sort):
+            continue
+        if {field for field, _ in pattern[sort_end:sort_end + len(ranges)]} == ranges:
+            return True
+    return False
+
+def aggregate_workload_shapes(client, db_name, collections):
+    query = {'docsExamined': {'$gt': 0}}
+    if collections:
+        query['ns'] = {'$in': [f"{db_name}.{col_name}" for col_name in collections]}
+    shapes = {}
+    for entry in client[db_name]['system.profile'].find(query, PROFILE_PROJECTION).batch_size(10000):
+        shape = workload_shape(entry)
+        if shape is None or entry.get('ns', '').endswith('.system.profile'):
+            continue
+        returned = entry.get('nreturned', entry.get('nMatched', entry.get('ndeleted', 0))) or 0
+        stats = shapes.setdefault((entry['ns'], shape), {'count': 0, 'examined': 0, 'returned': 0})
+        stats['count'] += 1
+        stats['examined'] += entry.get('docsExamined', 0)
+        stats['returned'] += returned
+    return shapes
+
+def find_missing_indexes(client, db_name, collections):
+    lookups = {}
+    candidates = {}
+    for (ns, shape), stats in aggregate_workload_shapes(client, db_name, collections).items():
+        if ns not in lookups:
+            col_name = ns.split('.', 1)[1]
+            try:
+                lookups[ns] = build_prefix_lookup(fetch_indexes(client[db_name][col_name]))
+            except Exception as e:
+                print(f"Error reading indexes of {ns}: {e}")
+                lookups[ns] = None
+        if lookups[ns] is None or shape_served(lookups[ns], shape):
+            continue
+        saved = stats['examined'] - stats['returned']
+        if saved <= 0:
+            continue
+        candidate = candidates.setdefault((ns, esr_key(shape)), {'shapes': 0, 'count': 0, 'examined': 0, 'saved': 0})
+        candidate['shapes'] += 1
+        candidate['count'] += stats['count']
+        candidate['examined'] += stats['examined']
+        candidate['saved'] += saved
+    return sorted(candidates.items(), key=lambda item: item[1]['saved'], reverse=True)
+
+def collection_tasks(client, databases, args):
+    for db_name in databases:
+        db = client[db_name]
+
+        if args.all_collections:
+            collections = get_all_collections(db)
+        elif args.collections:
+            collections = args.collections.split(',')
+        else:
+            print(f"No collections specified for database '{db_name}'. Use --all-collections or --collections to specify collections.")
+            continue
+
+        for col_name in collections:
+            yield db_name, col_name
+
 def main(args):
     client = MongoClient(
         host=args.host,
         port=args.port,
         username=args.user,
-        password=args.password
+        password=args.password,
+        maxPoolSize=max(args.workers, 1)
     )
 
     databases = []
@@ -66,45 +295,83 @@ def main(args):
         print("No databases specified. Use --all-databases or --databases to specify databases.")
         return
 
-    result_count = 1
+    check_duplicated = args.check_duplicated or args.check_all
+    check_unused = args.check_unused or args.check_all
+    check_missing = args.check_missing
 
-    for db_name in databases:
-        db = client[db_name]
-        collections = []
+    node_clients = {}
+    node_sets = {}
+    node_pool = None
+    if args.all_nodes and check_unused:
+        node_clients, node_sets = get_node_clients(client, args, maxPoolSize=max(args.workers, 1))
+        node_pool = ThreadPoolExecutor(max_workers=min(64, max(args.workers, 1) * len(node_clients)))
+        print(f"Merging $indexStats from {len(node_clients)} nodes: {', '.join(node_clients)}")
+    min_window = timedelta(hours=args.min_observation_hours)
 
-        if args.all_collections:
-            collections = get_all_collections(db)
-        elif args.collections:
-            collections = args.collections.split(',')
-        else:
-            print(f"No collections specified for database '{db_name}'. Use --all-collections or --collections to specify collections.")
-            continue
+    def audit(task):
+        db_name, col_name = task
+        collection = client[db_name][col_name]
+        # One broken collection must not end pool.map and drop the results of the rest
+        try:
+            if node_pool:
+                return db_name, col_name, audit_collection_all_nodes(collection, check_duplicated, node_clients, node_sets, node_pool, min_window)
+            return db_name, col_name, audit_collection(collection, check_duplicated, check_unused) + ([], (0, []))
+        except Exception as e:
+            print(f"Error auditing {db_name}.{col_name}: {e}")
+            return db_name, col_name, ([], [], [], (0, []))
 
-        for col_name in collections:
-            collection = db[col_name]
+    result_count = 1
 
-            if args.check_duplicated or args.check_all:
-                duplicates = check_duplicated_indexes(db, collection)
-                if duplicates:
-                    for dup in duplicates:
-                        print(f"{result_count}- In database '{db_name}', collection '{col_name}', index '{dup[0]}' is a duplicate of '{dup[1]}'. You can delete '{dup[0]}'.")
-                        result_count += 1
+    # Results are printed in catalog order as soon as each collection is done
+    try:
+        tasks = collection_tasks(client, databases, args) if check_duplicated or check_unused else []
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for db_name, col_name, (duplicates, unused, too_recent, (unreachable, unknown)) in pool.map(audit, tasks):
+                for dup in duplicates:
+                    print(f"{result_count}- In database '{db_name}', collection '{col_name}', index '{dup[0]}' is a duplicate of '{dup[1]}'. You can delete '{dup[0]}'.")
+                    result_count += 1
 
-            if args.check_unused or args.check_all:
-                unused = check_unused_indexes(db, collection)
                 if unused:
                     print(f"{result_count}- In database '{db_name}', collection '{col_name}', unused indexes: {unused}. You can delete these.")
                     result_count += 1
 
+                if too_recent:
+                    print(f"{result_count}- In database '{db_name}', collection '{col_name}', indexes without ops but observed for less than {args.min_observation_hours} hours on some node: {too_recent}. Check again later.")
+                    result_count += 1
+
+                if unknown:
+                    print(f"{result_count}- In database '{db_name}', collection '{col_name}', indexes without ops on the reachable nodes: {unknown}. Usage unknown, {unreachable} nodes unreachable.")
+                    result_count += 1
+
+        if check_missing:
+            collections = args.collections.split(',') if args.collections and not args.all_collections else None
+            for db_name in databases:
+                for (ns, key), candidate in find_missing_indexes(client, db_name, collections)[:args.missing_limit]:
+                    index = ', '.join(f"'{field}': {direction}" for field, direction in key)
+                    print(f"{result_count}- In database '{db_name}', collection '{ns.split('.', 1)[1]}', create index {{{index}}}. "
+                          f"{candidate['count']} profiled queries in {candidate['shapes']} shapes examined {candidate['examined']} documents, about {candidate['saved']} of them would be saved.")
+                    result_count += 1
+    finally:
+        if node_pool:
+            node_pool.shutdown()
+        for node_client in node_clients.values():
+            if node_client is not client:
+                node_client.close()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Check for duplicated and unused indexes in MongoDB.')
     parser.add_argument('--check-duplicated', action='store_true', help='Run checks for duplicated indexes.')
     parser.add_argument('--check-unused', action='store_true', help='Run checks for unused indexes.')
     parser.add_argument('--check-all', action='store_true', help='Run all checks both unused and duplicated.')
+    parser.add_argument('--check-missing', action='store_true', help='Recommend compound indexes (equality, sort, range) for profiled query shapes that no existing index serves.')
+    parser.add_argument('--missing-limit', type=int, default=20, help='With --check-missing, maximum recommendations per database ranked by documents examined they would save (default: 20).')
     parser.add_argument('--all-databases', action='store_true', help='Check in all databases excluding system dbs.')
     parser.add_argument('--databases', type=str, help='Comma separated list of databases to check.')
     parser.add_argument('--all-collections', action='store_true', help='Check in all collections in the selected databases.')
     parser.add_argument('--collections', type=str, help='Comma separated list of collections to check.')
+    parser.add_argument('--all-nodes', action='store_true', help='Merge $indexStats from every replica set member and shard, an index is only unused when it has no ops on every node.')
+    parser.add_argument('--min-observation-hours', type=float, default=168, help='With --all-nodes, minimum hours since the index counters started on every node before an index is reported unused (default: 168).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of collections audited at the same time over a shared connection pool (default: 1).')
 
     # Add MongoDB connection arguments
     parser.add_argument('--host', type=str, default='localhost', help='MongoDB host')
@@ -114,7 +381,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    if args.check_duplicated or args.check_unused or args.check_all:
+    if args.check_duplicated or args.check_unused or args.check_all or args.check_missing:
         main(args)
     else:
-        print("Please provide either --check-duplicated, --check-unused, or --check-all argument to run the script.")
+        print("Please provide either --check-duplicated, --check-unused, --check-all or --check-missing argument to run the script.")
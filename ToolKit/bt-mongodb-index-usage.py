@@ -1,5 +1,13 @@
 import pymongo
 import argparse
+import csv
+import json
+import sys
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from index_stats import fetch_all_nodes, get_node_clients, index_status, merge_index_stats
 
 def get_command_line_args():
     parser = argparse.ArgumentParser(description='Get index statistics from a MongoDB collection or all collections.')
@@ -11,6 +19,18 @@ def get_command_line_args():
     parser.add_argument('--password', type=str, help='The password for MongoDB authentication.')
     parser.add_argument('--show-all', action='store_true', help='If specified, run the command for all collections in the cluster.')
     parser.add_argument('--ignore-databases', type=str, nargs='*', help='List of databases to ignore when --show-all is used.')
+    parser.add_argument('--all-nodes', action='store_true', help='Collect index statistics from every replica set member and shard in parallel and merge them by index name.')
+    parser.add_argument('--store', type=str, help='SQLite file where --sample-interval snapshots are stored and --report reads them from.')
+    parser.add_argument('--sample-interval', type=float, help='Take an index stats snapshot every N seconds into --store until interrupted.')
+    parser.add_argument('--samples', type=int, default=0, help='Number of snapshots taken with --sample-interval. Default is 0, run until interrupted.')
+    parser.add_argument('--report', action='store_true', help='Print the hottest and coldest indexes by ops/second from the snapshots in --store.')
+    parser.add_argument('--window-hours', type=float, default=24, help='Window covered by --report, ending now. Default is 24.')
+    parser.add_argument('--top', type=int, default=10, help='Number of hottest and coldest indexes printed by --report, or cold indexes printed by --cache-report. Default is 10.')
+    parser.add_argument('--cache-report', action='store_true', help='Estimate whether the most used indexes fit in the WiredTiger cache of the connected node and list cold indexes taking cache space.')
+    parser.add_argument('--hot-share', type=float, default=0.95, help='With --cache-report, share of all index ops that defines the hot indexes. Default is 0.95.')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv'], default='text', help='Output format, results are written per collection as soon as they arrive. Default is text.')
+    parser.add_argument('--output', type=str, help='Write results to this file instead of the console.')
+    parser.add_argument('--min-observation-hours', type=float, default=168, help='With --all-nodes, minimum hours since the counters started on every node before an index is reported unused. Default is 168.')
 
     return parser.parse_args()
 
@@ -35,9 +55,317 @@ def run_index_stats(collection):
         results = list(result)
         result_count = len(results)
     except pymongo.errors.PyMongoError as e:
-        print(f"An error occurred: {e}")
+        print(f"An error occurred: {e}", file=sys.stderr)
     return result_count, results
 
+def run_index_stats_all_nodes(node_clients, pool, db_name, coll_name):
+    node_stats = fetch_all_nodes(node_clients, pool, db_name, coll_name)
+    results = []
+    for node_result in node_stats.values():
+        results.extend(node_result or [])
+    return len(results), results, node_stats
+
+STATUS_TEXT = {
+    'used': 'used',
+    'unused': 'unused on every node',
+    'too recent': 'no ops yet, observation window too short'
+}
+
+def merge_node_index_stats(node_stats, node_sets, min_window):
+    merged = merge_index_stats(node_stats, node_sets)
+    for entry in merged.values():
+        status = index_status(entry, min_window)
+        entry['status'] = STATUS_TEXT.get(status) or f"unknown, {entry['unreachable']} nodes unreachable"
+    return merged
+
+def format_merged_line_by_line(namespace, merged):
+    lines = []
+    for name, entry in merged.items():
+        lines.append(f"namespace: {namespace}")
+        lines.append(f"name: {name}")
+        lines.append(f"key: {entry['key']}")
+        lines.append(f"nodes: {entry['nodes']}")
+        lines.append(f"ops (all nodes): {entry['ops']}")
+        lines.append(f"shortest observation: {entry['observed']}")
+        lines.append(f"status: {entry['status']}")
+        lines.append("")
+    return "\n".join(lines)
+
+OUTPUT_FIELDS = ['record', 'namespace', 'name', 'key', 'host', 'shard', 'ops', 'since', 'spec', 'nodes', 'observed', 'status']
+
+def result_rows(namespace, results):
+    for doc in results:
+        yield {
+            'record': 'index',
+            'namespace': namespace,
+            'name': doc.get('name', ''),
+            'key': doc.get('key', ''),
+            'host': doc.get('host', ''),
+            'shard': doc.get('shard', ''),
+            'ops': doc.get('accesses', {}).get('ops', ''),
+            'since': doc.get('accesses', {}).get('since', ''),
+            'spec': doc.get('spec', '')
+        }
+
+def merged_rows(namespace, merged):
+    for name, entry in merged.items():
+        yield {
+            'record': 'merged',
+            'namespace': namespace,
+            'name': name,
+            'key': entry['key'],
+            'nodes': entry['nodes'],
+            'ops': entry['ops'],
+            'observed': entry['observed'],
+            'status': entry['status']
+        }
+
+def open_output(fmt, path):
+    stream = open(path, 'w', newline='') if path else sys.stdout
+    output = {'format': fmt, 'stream': stream, 'csv': None}
+    if fmt == 'csv':
+        output['csv'] = csv.DictWriter(stream, fieldnames=OUTPUT_FIELDS, extrasaction='ignore')
+        output['csv'].writeheader()
+    return output
+
+def write_collection(output, namespace, results, merged):
+    # One collection at a time, nothing is kept once it is written
+    stream = output['stream']
+    if output['format'] == 'text':
+        if results:
+            stream.write(format_result_line_by_line(results) + "\n")
+        if merged:
+            stream.write(format_merged_line_by_line(namespace, merged) + "\n")
+    else:
+        rows = list(result_rows(namespace, results))
+        if merged:
+            rows.extend(merged_rows(namespace, merged))
+        for row in rows:
+            if output['format'] == 'jsonl':
+                stream.write(json.dumps(row, default=str) + "\n")
+            else:
+                output['csv'].writerow({field: json.dumps(value, default=str) if isinstance(value, dict) else value for field, value in row.items()})
+    stream.flush()
+
+def close_output(output):
+    if output['stream'] is not sys.stdout:
+        output['stream'].close()
+
+def open_snapshot_store(path):
+    # Names are stored once, samples are small integer rows written only when a counter moved
+    store = sqlite3.connect(path)
+    store.executescript("""
+        CREATE TABLE IF NOT EXISTS indexes (
+            index_id INTEGER PRIMARY KEY,
+            host TEXT NOT NULL,
+            namespace TEXT NOT NULL,
+            name TEXT NOT NULL,
+            UNIQUE (host, namespace, name)
+        );
+        CREATE TABLE IF NOT EXISTS sweeps (
+            ts INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS samples (
+            index_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            ops INTEGER NOT NULL,
+            since INTEGER NOT NULL,
+            PRIMARY KEY (index_id, ts)
+        ) WITHOUT ROWID;
+    """)
+    return store
+
+def to_epoch(value):
+    if isinstance(value, datetime):
+        return int(value.replace(tzinfo=timezone.utc).timestamp())
+    return 0
+
+def save_snapshot(store, ts, snapshot, index_ids, last_samples):
+    rows = []
+    for namespace, doc in snapshot:
+        key = (doc.get('host', ''), namespace, doc.get('name', ''))
+        index_id = index_ids.get(key)
+        if index_id is None:
+            store.execute("INSERT OR IGNORE INTO indexes (host, namespace, name) VALUES (?, ?, ?)", key)
+            index_id = index_ids[key] = store.execute("SELECT index_id FROM indexes WHERE host = ? AND namespace = ? AND name = ?", key).fetchone()[0]
+
+        accesses = doc.get('accesses', {})
+        sample = (accesses.get('ops', 0), to_epoch(accesses.get('since')))
+        if last_samples.get(index_id) != sample:
+            rows.append((index_id, ts) + sample)
+            last_samples[index_id] = sample
+
+    with store:
+        store.execute("INSERT OR IGNORE INTO sweeps (ts) VALUES (?)", (ts,))
+        store.executemany("INSERT OR REPLACE INTO samples (index_id, ts, ops, since) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+def load_last_samples(store):
+    rows = store.execute("""
+        SELECT samples.index_id, samples.ops, samples.since FROM samples
+        JOIN (SELECT index_id, MAX(ts) AS ts FROM samples GROUP BY index_id) AS latest
+        ON latest.index_id = samples.index_id AND latest.ts = samples.ts
+    """)
+    return {index_id: (ops, since) for index_id, ops, since in rows}
+
+def index_rates(store, start, end):
+    # The last sample before the window is the baseline, a changed since means the counter restarted from zero
+    rows = store.execute("""
+        SELECT indexes.index_id, host, namespace, name, ts, ops, since FROM samples
+        JOIN indexes ON indexes.index_id = samples.index_id
+        WHERE ts <= ? AND (ts >= ? OR ts = (SELECT MAX(ts) FROM samples AS baseline WHERE baseline.index_id = samples.index_id AND baseline.ts < ?))
+        ORDER BY samples.index_id, ts
+    """, (end, start, start))
+
+    rates = {}
+    previous = {}
+    for index_id, host, namespace, name, ts, ops, since in rows:
+        entry = rates.setdefault(index_id, {'host': host, 'namespace': namespace, 'name': name, 'ops': 0, 'resets': 0, 'first_ts': ts})
+        last = previous.get(index_id)
+        if last is not None:
+            last_ops, last_since = last
+            if since != last_since or ops < last_ops:
+                entry['ops'] += ops
+                entry['resets'] += 1
+            else:
+                entry['ops'] += ops - last_ops
+        previous[index_id] = (ops, since)
+
+    # Samples are only written when a counter moved, so the counters held their value up to the last sweep.
+    # Each index is divided by the time it was actually covered, not by the requested window.
+    last_sweep = store.execute("SELECT MAX(ts) FROM sweeps WHERE ts <= ?", (end,)).fetchone()[0] or end
+    for entry in rates.values():
+        entry['span'] = max(last_sweep - entry.pop('first_ts'), 1)
+        entry['rate'] = entry['ops'] / entry['span']
+    return list(rates.values())
+
+def print_index_rates_report(store, window_hours, top):
+    end = int(time.time())
+    start = end - int(window_hours * 3600)
+    sweeps = store.execute("SELECT COUNT(*), MIN(ts), MAX(ts) FROM sweeps WHERE ts BETWEEN ? AND ?", (start, end)).fetchone()
+    if not sweeps[0]:
+        print(f"No snapshots found in the last {window_hours} hours.")
+        return
+
+    rates = sorted(index_rates(store, start, end), key=lambda entry: entry['rate'], reverse=True)
+    print(f"Snapshots: {sweeps[0]} between {datetime.fromtimestamp(sweeps[1], timezone.utc)} and {datetime.fromtimestamp(sweeps[2], timezone.utc)}")
+    for title, entries in (("Hottest indexes", rates[:top]), ("Coldest indexes", list(reversed(rates))[:top])):
+        print(f"\n{title} (ops/second over the sampled span, at most the last {window_hours} hours):")
+        for entry in entries:
+            print(f"{entry['rate']:>12.4f}  {entry['namespace']}  {entry['name']}  host: {entry['host']}  ops: {entry['ops']}  resets: {entry['resets']}  span: {timedelta(seconds=entry['span'])}")
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(size) < 1024 or unit == 'TiB':
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+def wiredtiger_cache_stats(client):
+    status = client.admin.command('serverStatus')
+    cache = status.get('wiredTiger', {}).get('cache', {})
+    uptime = max(status.get('uptime', 0), 1)
+    return {
+        'max': cache.get('maximum bytes configured', 0),
+        'used': cache.get('bytes currently in the cache', 0),
+        'dirty': cache.get('tracked dirty bytes in the cache', 0),
+        'pages_read': cache.get('pages read into cache', 0),
+        'pages_read_rate': cache.get('pages read into cache', 0) / uptime,
+        'resident': status.get('mem', {}).get('resident', 0) * 1024 * 1024
+    }
+
+def collect_index_footprint(client, db_name, coll_name):
+    # collStats gives the on-disk size and, per index, the bytes WiredTiger currently holds in cache
+    try:
+        stats = client[db_name].command('collStats', coll_name)
+        index_stats = list(client[db_name][coll_name].aggregate([{'$indexStats': {}}]))
+    except pymongo.errors.PyMongoError as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        return []
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    accesses = {doc.get('name'): doc.get('accesses', {}) for doc in index_stats}
+    footprint = []
+    for name, size in stats.get('indexSizes', {}).items():
+        access = accesses.get(name, {})
+        since = access.get('since')
+        seconds = max((now - since).total_seconds(), 1) if isinstance(since, datetime) else 0
+        cached = stats.get('indexDetails', {}).get(name, {}).get('cache', {}).get('bytes currently in the cache')
+        footprint.append({
+            'namespace': f"{db_name}.{coll_name}",
+            'name': name,
+            'size': size,
+            'cached': cached,
+            'ops': access.get('ops', 0),
+            'rate': access.get('ops', 0) / seconds if seconds else 0
+        })
+    return footprint
+
+def print_cache_report(footprint, cache, hot_share, top):
+    # Hot indexes are the most used ones that together account for hot_share of all index ops
+    footprint.sort(key=lambda entry: entry['rate'], reverse=True)
+    total_rate = sum(entry['rate'] for entry in footprint)
+    hot = []
+    hot_rate = 0
+    for entry in footprint:
+        if total_rate and hot_rate >= total_rate * hot_share:
+            break
+        if entry['rate'] <= 0:
+            break
+        hot.append(entry)
+        hot_rate += entry['rate']
+    hot_size = sum(entry['size'] for entry in hot)
+    total_size = sum(entry['size'] for entry in footprint)
+    # WiredTiger starts evicting at 80% of the configured cache, and collection data shares the same cache
+    budget = cache['max'] * 0.8
+
+    print(f"WiredTiger cache: {format_bytes(cache['used'])} used of {format_bytes(cache['max'])} ({cache['used'] / max(cache['max'], 1) * 100:.1f}%), dirty {format_bytes(cache['dirty'])}, resident memory {format_bytes(cache['resident'])}")
+    print(f"Pages read into cache: {cache['pages_read']} ({cache['pages_read_rate']:.1f}/second since startup)")
+    print(f"Indexes: {len(footprint)} totalling {format_bytes(total_size)}")
+    print(f"Hot indexes: {len(hot)} serving {hot_share * 100:.0f}% of index ops, totalling {format_bytes(hot_size)} ({hot_size / max(budget, 1) * 100:.1f}% of the eviction target {format_bytes(budget)})")
+    if hot_size <= budget:
+        print(f"Hot indexes fit in cache with {format_bytes(budget - hot_size)} left for collection data.")
+    else:
+        print(f"Hot indexes do not fit in cache, {format_bytes(hot_size - budget)} more cache (or fewer/smaller hot indexes) is needed.")
+
+    hot_names = {(entry['namespace'], entry['name']) for entry in hot}
+    cold = [entry for entry in footprint if (entry['namespace'], entry['name']) not in hot_names]
+    # Without per-index cache stats the whole index size is the worst case it can take
+    cold.sort(key=lambda entry: (entry['cached'] if entry['cached'] is not None else entry['size'], -entry['rate']), reverse=True)
+    print(f"\nCold indexes taking the most cache (top {top}):")
+    for entry in cold[:top]:
+        cached = format_bytes(entry['cached']) if entry['cached'] is not None else 'n/a'
+        print(f"{entry['namespace']}  {entry['name']}  size: {format_bytes(entry['size'])}  in cache: {cached}  ops/second: {entry['rate']:.4f}")
+
+def iter_namespaces(client, args):
+    if not args.show_all:
+        yield args.database, args.collection
+        return
+    # Iterate over all databases and collections, ignoring specified databases
+    ignore_dbs = args.ignore_databases if args.ignore_databases else []
+    for db_name in client.list_database_names():
+        if db_name in ignore_dbs:
+            print(f"Ignoring database {db_name}", file=sys.stderr)
+            continue
+        for coll_name in client[db_name].list_collection_names():
+            yield db_name, coll_name
+
+def run_sampling(args, collect, client, store):
+    index_ids = {}
+    last_samples = load_last_samples(store)
+    taken = 0
+    while not args.samples or taken < args.samples:
+        started = time.time()
+        snapshot = []
+        for db_name, coll_name in iter_namespaces(client, args):
+            _, results, _ = collect(db_name, coll_name)
+            snapshot.extend((f"{db_name}.{coll_name}", doc) for doc in results)
+        changed = save_snapshot(store, int(started), snapshot, index_ids, last_samples)
+        taken += 1
+        print(f"Snapshot {taken}: {len(snapshot)} index stats, {changed} changed")
+        if args.samples and taken >= args.samples:
+            break
+        time.sleep(max(0, args.sample_interval - (time.time() - started)))
+
 def main():
     # Get command-line arguments
     args = get_command_line_args()
@@ -48,46 +376,74 @@ def main():
     else:
         connection_string = f"mongodb://{args.host}:{args.port}/"
 
+    if args.report:
+        if not args.store:
+            print("You must specify --store with --report.")
+            return
+        print_index_rates_report(open_snapshot_store(args.store), args.window_hours, args.top)
+        return
+
+    if args.sample_interval and not args.store:
+        print("You must specify --store with --sample-interval.")
+        return
+
+    if not args.show_all and (not args.database or not args.collection):
+        print("You must specify both --database and --collection unless --show-all is used.")
+        return
+
     # Establish a connection to MongoDB
     client = pymongo.MongoClient(connection_string)
 
     total_results = 0
-    all_results = []
-
-    if args.show_all:
-        # Iterate over all databases and collections, ignoring specified databases
-        ignore_dbs = args.ignore_databases if args.ignore_databases else []
-        for db_name in client.list_database_names():
-            if db_name in ignore_dbs:
-                print(f"Ignoring database {db_name}")
-                continue
-            db = client[db_name]
-            for coll_name in db.list_collection_names():
-                print(f"Running index stats for {db_name}.{coll_name}")
-                collection = db[coll_name]
-                result_count, results = run_index_stats(collection)
-                total_results += result_count
-                all_results.extend(results)
-    else:
-        if not args.database or not args.collection:
-            print("You must specify both --database and --collection unless --show-all is used.")
-            return
-        
-        db = client[args.database]
-        collection = db[args.collection]
-        print(f"Running index stats for {args.database}.{args.collection}")
-        result_count, results = run_index_stats(collection)
-        total_results += result_count
-        all_results.extend(results)
+    # Progress goes to stderr so jsonl and csv output stays machine readable
+    log = sys.stdout if args.format == 'text' and not args.output else sys.stderr
+
+    node_clients = {}
+    node_sets = {}
+    pool = None
+    if args.all_nodes:
+        node_clients, node_sets = get_node_clients(client, args)
+        pool = ThreadPoolExecutor(max_workers=min(64, len(node_clients)))
+        print(f"Collecting index stats from {len(node_clients)} nodes: {', '.join(node_clients)}", file=log)
+    min_window = timedelta(hours=args.min_observation_hours)
+
+    def collect(db_name, coll_name):
+        if not args.all_nodes:
+            return run_index_stats(client[db_name][coll_name]) + (None,)
+        return run_index_stats_all_nodes(node_clients, pool, db_name, coll_name)
+
+    try:
+        if args.cache_report:
+            footprint = []
+            for db_name, coll_name in iter_namespaces(client, args):
+                footprint.extend(collect_index_footprint(client, db_name, coll_name))
+            print_cache_report(footprint, wiredtiger_cache_stats(client), args.hot_share, args.top)
+        elif args.sample_interval:
+            run_sampling(args, collect, client, open_snapshot_store(args.store))
+        else:
+            output = open_output(args.format, args.output)
+            try:
+                for db_name, coll_name in iter_namespaces(client, args):
+                    print(f"Running index stats for {db_name}.{coll_name}", file=log)
+                    result_count, results, node_stats = collect(db_name, coll_name)
+                    total_results += result_count
+                    merged = merge_node_index_stats(node_stats, node_sets, min_window) if args.all_nodes else None
+                    write_collection(output, f"{db_name}.{coll_name}", results, merged)
+            finally:
+                close_output(output)
+    except KeyboardInterrupt:
+        pass
 
     # Close the MongoDB connection
+    if pool:
+        pool.shutdown()
+    for node_client in node_clients.values():
+        if node_client is not client:
+            node_client.close()
     client.close()
 
-    # Display the results line by line
-    if all_results:
-        print(format_result_line_by_line(all_results))
-
-    print(f"\nTotal number of results returned: {total_results}")
+    if not args.sample_interval and not args.cache_report:
+        print(f"\nTotal number of results returned: {total_results}", file=log)
 
 if __name__ == "__main__":
     main()
@@ -1,27 +1,255 @@
 import argparse
+import fnmatch
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pymongo import MongoClient
-from pymongo.errors import OperationFailure
+from pymongo.errors import OperationFailure, PyMongoError
 
-def get_long_running_operations(client, threshold_seconds, ignore_dbs):
-    admin_db = client.admin
+OP_FIELDS = ['opid', 'shard', 'host', 'desc', 'connectionId', 'client', 'client_s', 'appName', 'active', 'secs_running',
+             'microsecs_running', 'op', 'ns', 'command', 'planSummary', 'numYields']
+
+def build_current_op_pipeline(threshold_seconds, ignore_dbs, op_types, local_ops=False):
+    # Filtering and projecting on the server keeps the reply small when the node is already struggling
+    match = {'active': True, 'secs_running': {'$gte': threshold_seconds}}
+    if ignore_dbs:
+        match['ns'] = {'$not': re.compile('^(?:' + '|'.join(re.escape(db) for db in ignore_dbs) + r')(?:\.|$)')}
+    if op_types:
+        match['op'] = {'$in': list(op_types)}
+    else:
+        match['op'] = {'$ne': 'none'}
+    return [
+        {'$currentOp': {'allUsers': True, 'idleConnections': False, 'localOps': local_ops}},
+        {'$match': match},
+        {'$project': {field: 1 for field in OP_FIELDS}}
+    ]
+
+def get_long_running_operations(client, threshold_seconds, ignore_dbs, op_types=None, batch_size=100, local_ops=False):
+    # Accept both "--ignore-databases a b" and "--ignore-databases a,b"
+    ignore_dbs = [db for item in ignore_dbs for db in item.split(',') if db]
+    # Errors reach the caller, an empty result must mean that nothing is running
+    return client.admin.aggregate(build_current_op_pipeline(threshold_seconds, ignore_dbs, op_types, local_ops), batchSize=batch_size)
+
+def get_shard_clients(client, args):
+    if client.admin.command('isMaster').get('msg') != 'isdbgrid':
+        return None
+    shard_clients = {}
+    for shard in client.admin.command('listShards')['shards']:
+        set_name, _, hosts = shard['host'].rpartition('/')
+        shard_clients[shard['_id']] = MongoClient(hosts.split(','), replicaSet=set_name or None, username=args.user, password=args.password, authSource='admin')
+    return shard_clients
+
+def fetch_source_operations(source_client, shard, threshold_seconds, ignore_dbs, args, failed):
+    # mongos only reports its own work with localOps, shard primaries report theirs directly
     try:
-        current_op = admin_db.command('currentOp')
-    except OperationFailure as e:
-        print(f"Failed to run currentOp command: {e}")
+        ops = list(get_long_running_operations(source_client, threshold_seconds, ignore_dbs, args.op_types, args.batch_size, local_ops=shard is None))
+    except PyMongoError as e:
+        print(f"Failed to poll operations on {shard or 'mongos'}: {e}")
+        failed.add(shard)
         return []
+    if shard:
+        # killOp through mongos needs the shard qualified opid
+        for op in ops:
+            op['opid'] = f"{shard}:{op['opid']}"
+            op['shard'] = shard
+    return ops
 
-    long_running_ops = [
-        op for op in current_op.get('inprog', [])
-        if op.get('secs_running', 0) >= threshold_seconds and op.get('ns', '').split('.')[0] not in ignore_dbs
-    ]
-    return long_running_ops
+def get_cluster_operations(client, shard_clients, pool, threshold_seconds, ignore_dbs, args, failed):
+    sources = [(client, None)] + [(shard_client, shard) for shard, shard_client in shard_clients.items()]
+    # Every source is polled at the same time, so a poll takes as long as the slowest shard, not the sum.
+    # Sources that failed are added to failed (None for mongos) so their ops are not taken as finished.
+    for ops in pool.map(lambda source: fetch_source_operations(source[0], source[1], threshold_seconds, ignore_dbs, args, failed), sources):
+        yield from ops
+
+def op_source(opid):
+    # Shard ops carry a "shard:" prefix, mongos local ops are plain numbers
+    return opid.split(':', 1)[0] if isinstance(opid, str) else None
 
 def kill_operation(client, op_id):
     try:
         client.admin.command('killOp', op=op_id)
         print(f"Killed operation {op_id}")
-    except OperationFailure as e:
+        return True
+    except PyMongoError as e:
         print(f"Failed to kill operation {op_id}: {e}")
+        return False
+
+def new_rate_limiter(rate, burst):
+    return {'rate': rate, 'burst': burst, 'tokens': burst, 'updated': time.monotonic()}
+
+def acquire(limiter):
+    # Token bucket, an op that does not get a token is retried on the next poll
+    if not limiter['rate']:
+        return True
+    now = time.monotonic()
+    limiter['tokens'] = min(limiter['burst'], limiter['tokens'] + (now - limiter['updated']) * limiter['rate'])
+    limiter['updated'] = now
+    if limiter['tokens'] < 1:
+        return False
+    limiter['tokens'] -= 1
+    return True
+
+def audit_record(op, action, rule=None):
+    return {
+        'ts': datetime.now(timezone.utc).isoformat(),
+        'action': action,
+        'rule': rule['name'] if rule else None,
+        'opid': op.get('opid'),
+        'ns': op.get('ns'),
+        'op': op.get('op'),
+        'client': op.get('client') or op.get('client_s'),
+        'appName': op.get('appName'),
+        'planSummary': op.get('planSummary'),
+        'secs_running': op.get('secs_running'),
+        'host': op.get('host')
+    }
+
+def write_audit(audit, record):
+    if audit:
+        audit.write(json.dumps(record, default=str) + "\n")
+        audit.flush()
+
+RULE_KEYS = {'name', 'action', 'ns', 'op', 'command', 'app', 'client', 'desc', 'plan', 'after'}
+
+def as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+def namespace_matcher(patterns):
+    # Exact namespaces and whole databases are set lookups, only real wildcards fall back to one combined regex
+    matcher = {'ns': set(), 'dbs': set(), 'regex': None}
+    wildcards = []
+    for pattern in as_list(patterns):
+        if pattern.endswith('.*') and not any(char in pattern[:-2] for char in '*?['):
+            matcher['dbs'].add(pattern[:-2])
+        elif any(char in pattern for char in '*?['):
+            wildcards.append(fnmatch.translate(pattern))
+        else:
+            matcher['ns'].add(pattern)
+    if wildcards:
+        matcher['regex'] = re.compile('|'.join(wildcards))
+    return matcher
+
+def compile_rule(index, rule):
+    unknown = set(rule) - RULE_KEYS
+    if unknown:
+        raise ValueError(f"Rule {index} has unknown keys: {', '.join(sorted(unknown))}")
+    if rule.get('action') not in ('kill', 'ignore'):
+        raise ValueError(f"Rule {index} needs an action of 'kill' or 'ignore'")
+    return {
+        'name': rule.get('name', f"rule-{index}"),
+        'action': rule['action'],
+        'after': rule.get('after', 0),
+        'ops': set(as_list(rule['op'])) if 'op' in rule else None,
+        'commands': set(as_list(rule['command'])) if 'command' in rule else None,
+        'ns': namespace_matcher(rule['ns']) if 'ns' in rule else None,
+        'app': re.compile(rule['app']) if 'app' in rule else None,
+        'client': re.compile(rule['client']) if 'client' in rule else None,
+        'desc': re.compile(rule['desc']) if 'desc' in rule else None,
+        'plan': re.compile(rule['plan']) if 'plan' in rule else None
+    }
+
+def load_policy(path):
+    with open(path) as f:
+        document = json.load(f)
+    rules = document['rules'] if isinstance(document, dict) else document
+    return [compile_rule(index, rule) for index, rule in enumerate(rules, 1)]
+
+def policy_threshold(policy, busy_time):
+    # The server side filter has to let through everything the most eager kill rule could fire on
+    afters = [rule['after'] for rule in policy if rule['action'] == 'kill']
+    if busy_time is not None:
+        afters.append(busy_time)
+    return min(afters) if afters else 0
+
+def match_rule(rule, op):
+    # Cheapest checks first, regexes last
+    if op.get('secs_running', 0) < rule['after']:
+        return False
+    if rule['ops'] is not None and op.get('op') not in rule['ops']:
+        return False
+    if rule['commands'] is not None and next(iter(op.get('command') or {}), None) not in rule['commands']:
+        return False
+    if rule['ns'] is not None:
+        ns = op.get('ns', '')
+        matcher = rule['ns']
+        if ns not in matcher['ns'] and ns.split('.', 1)[0] not in matcher['dbs'] and not (matcher['regex'] and matcher['regex'].match(ns)):
+            return False
+    for key, field in (('app', 'appName'), ('desc', 'desc'), ('plan', 'planSummary')):
+        if rule[key] is not None and not rule[key].search(op.get(field) or ''):
+            return False
+    if rule['client'] is not None and not rule['client'].search(op.get('client') or op.get('client_s') or ''):
+        return False
+    return True
+
+def policy_decision(policy, op):
+    # First matching rule wins, operations no rule matches are left alone
+    if policy is None:
+        return 'kill', None
+    for rule in policy:
+        if match_rule(rule, op):
+            return rule['action'], rule
+    return 'none', None
+
+def report_dry_run(op, action, rule, audit):
+    rule_name = rule['name'] if rule else 'no rule'
+    print(f"Would {'kill' if action == 'kill' else 'keep'} operation {op['opid']} ({op.get('op')} on {op.get('ns')}, {op.get('secs_running')}s): {rule_name}")
+    write_audit(audit, audit_record(op, f"dry-run {action}", rule))
+
+def watch_operations(client, args, poll, policy, audit):
+    limiter = new_rate_limiter(args.max_kills_per_second, max(args.max_kills_per_second, 1))
+    handled = set()
+    polls = 0
+    with ThreadPoolExecutor(max_workers=args.kill_workers) as pool:
+        while True:
+            started = time.monotonic()
+            polls += 1
+            running = set()
+            failed = set()
+            to_kill = []
+            try:
+                for op in poll(failed):
+                    running.add(op['opid'])
+                    # killOp is asynchronous, an op can still be listed on the next poll after it was killed
+                    if op['opid'] in handled:
+                        continue
+                    action, rule = policy_decision(policy, op)
+                    if args.dry_run:
+                        report_dry_run(op, action, rule, audit)
+                        handled.add(op['opid'])
+                    elif action != 'kill':
+                        continue
+                    elif args.action == 'print':
+                        print(op)
+                        write_audit(audit, audit_record(op, 'print', rule))
+                        handled.add(op['opid'])
+                    elif acquire(limiter):
+                        to_kill.append((op, rule))
+            except PyMongoError as e:
+                # A failed poll must not stop the watchdog, the next one starts from scratch
+                print(f"Failed to poll operations: {e}")
+                running = set(handled)
+            # Opids from a source that did not answer are kept until it answers again
+            running |= {opid for opid in handled if op_source(opid) in failed}
+
+            for (op, rule), killed in zip(to_kill, pool.map(lambda item: kill_operation(client, item[0]['opid']), to_kill)):
+                write_audit(audit, audit_record(op, 'killed' if killed else 'kill failed', rule))
+                # A failed kill is retried on the next poll
+                if killed:
+                    handled.add(op['opid'])
+            handled &= running
+
+            if args.polls and polls >= args.polls:
+                break
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+def close_clients(client, shard_clients, poll_pool):
+    if poll_pool:
+        poll_pool.shutdown()
+    for shard_client in (shard_clients or {}).values():
+        shard_client.close()
+    client.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Manage long-running MongoDB queries.')
@@ -29,28 +257,102 @@ def main():
     parser.add_argument('--port', type=int, default=27017, help='MongoDB port (default: 27017)')
     parser.add_argument('--user', default=None, help='MongoDB user (default: None)')
     parser.add_argument('--password', default=None, help='MongoDB password (default: None)')
-    parser.add_argument('--busy-time', type=int, required=True, help='Threshold for long-running queries in seconds')
+    parser.add_argument('--busy-time', type=int, default=None, help='Threshold for long-running queries in seconds, required unless --policy is given')
     parser.add_argument('--action', choices=['kill', 'print'], required=True, help='Action to perform on long-running queries')
     parser.add_argument('--all-databases', action='store_true', help='Include operations from all databases')
     parser.add_argument('--ignore-databases', nargs='*', default=[], help='Databases to ignore when using --all-databases')
+    parser.add_argument('--op-types', nargs='*', default=[], help='Only match these operation types, e.g. query command getmore (default: every active op)')
+    parser.add_argument('--batch-size', type=int, default=100, help='Number of operations fetched per $currentOp batch (default: 100)')
+    parser.add_argument('--watch', action='store_true', help='Keep running and poll for long-running operations every --interval seconds')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between polls with --watch (default: 5)')
+    parser.add_argument('--polls', type=int, default=0, help='Stop after this many polls with --watch (default: 0, run until interrupted)')
+    parser.add_argument('--kill-workers', type=int, default=4, help='Maximum killOp commands sent at the same time with --watch (default: 4)')
+    parser.add_argument('--max-kills-per-second', type=float, default=10, help='Rate limit for killOp with --watch, 0 disables it (default: 10)')
+    parser.add_argument('--sharded', action='store_true', help='Connected to mongos: poll mongos and every shard primary concurrently and kill with shard qualified opids')
+    parser.add_argument('--policy', default=None, help='JSON file with kill rules, the first matching rule decides whether an operation is killed')
+    parser.add_argument('--dry-run', action='store_true', help='Only report which rule would fire for every matching operation, nothing is killed')
+    parser.add_argument('--audit-log', default=None, help='Append a JSON line per printed or killed operation to this file')
 
     args = parser.parse_args()
 
+    policy = None
+    if args.policy:
+        try:
+            policy = load_policy(args.policy)
+        except (OSError, ValueError, KeyError, re.error) as e:
+            print(f"Failed to load policy {args.policy}: {e}")
+            return
+    elif args.busy_time is None:
+        parser.error('--busy-time is required unless --policy is given')
+    threshold = policy_threshold(policy, args.busy_time) if policy else args.busy_time
+
     client = MongoClient(host=args.host, port=args.port, username=args.user, password=args.password, authSource='admin')
 
-    if args.all_databases:
-        long_running_ops = get_long_running_operations(client, args.busy_time, args.ignore_databases)
-    else:
-        long_running_ops = get_long_running_operations(client, args.busy_time, [])
+    ignore_dbs = args.ignore_databases if args.all_databases else []
+
+    shard_clients = None
+    poll_pool = None
+    if args.sharded:
+        shard_clients = get_shard_clients(client, args)
+        if shard_clients is None:
+            print("--sharded needs a connection to mongos.")
+            client.close()
+            return
+        poll_pool = ThreadPoolExecutor(max_workers=len(shard_clients) + 1)
 
-    if args.action == 'print':
-        for op in long_running_ops:
+    def poll(failed):
+        if shard_clients is None:
+            return get_long_running_operations(client, threshold, ignore_dbs, args.op_types, args.batch_size)
+        return get_cluster_operations(client, shard_clients, poll_pool, threshold, ignore_dbs, args, failed)
+
+    if args.watch:
+        audit = open(args.audit_log, 'a') if args.audit_log else None
+        try:
+            watch_operations(client, args, poll, policy, audit)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if audit:
+                audit.close()
+            close_clients(client, shard_clients, poll_pool)
+        return
+
+    try:
+        long_running_ops = poll(set())
+    except OperationFailure as e:
+        print(f"Failed to run $currentOp aggregation: {e}")
+        long_running_ops = []
+    audit = open(args.audit_log, 'a') if args.audit_log else None
+
+    # Operations are handled batch by batch as the cursor returns them
+    total = 0
+    for op in long_running_ops:
+        action, rule = policy_decision(policy, op)
+        if args.dry_run:
+            report_dry_run(op, action, rule, audit)
+            total += action == 'kill'
+        elif action != 'kill':
+            continue
+        elif args.action == 'print':
             print(op)
-        print(f"Total number of printed operations: {len(long_running_ops)}")
-    elif args.action == 'kill':
-        for op in long_running_ops:
-            kill_operation(client, op['opid'])
-        print(f"Total number of killed operations: {len(long_running_ops)}")
+            write_audit(audit, audit_record(op, 'print', rule))
+            total += 1
+        else:
+            killed = kill_operation(client, op['opid'])
+            write_audit(audit, audit_record(op, 'killed' if killed else 'kill failed', rule))
+            total += 1
+
+    close_clients(client, shard_clients, poll_pool)
+
+    if args.dry_run:
+        print(f"Total number of operations that would be killed: {total}")
+    elif args.action == 'print':
+        print(f"Total number of printed operations: {total}")
+    else:
+        print(f"Total number of killed operations: {total}")
+
+    if audit:
+        audit.close()
 
 if __name__ == '__main__':
     main()
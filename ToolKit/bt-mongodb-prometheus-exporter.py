@@ -0,0 +1,253 @@
+import argparse
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import MongoClient
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPCOUNTERS = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+def get_mongo_client(host, port, username, password, authdb):
+    if username and password:
+        uri = f"mongodb://{username}:{password}@{host}:{port}/?authSource={authdb}"
+    else:
+        uri = f"mongodb://{host}:{port}/"
+    return MongoClient(uri, serverSelectionTimeoutMS=5000)
+
+def new_family(name, metric_type, help_text):
+    return {'name': name, 'type': metric_type, 'help': help_text, 'samples': []}
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_families(families):
+    lines = []
+    for family in families:
+        if not family['samples']:
+            continue
+        lines.append(f"# HELP {family['name']} {family['help']}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for labels, value in family['samples']:
+            label_text = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+            lines.append(f"{family['name']}{{{label_text}}} {float(value)!r}" if label_text else f"{family['name']} {float(value)!r}")
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def collect_heartbeat(client):
+    # Same checks as analyze_heartbeat_info in the heartbeat profilers, as numbers instead of text
+    status = client.admin.command('replSetGetStatus')
+    now = status['date']
+    health = new_family('mongodb_member_health', 'gauge', 'Member health as seen by the replica set (1 healthy, 0 down).')
+    state = new_family('mongodb_member_state', 'gauge', 'Member replica set state code.')
+    uptime = new_family('mongodb_member_uptime_seconds', 'gauge', 'Member uptime in seconds.')
+    heartbeat_age = new_family('mongodb_member_heartbeat_age_seconds', 'gauge', 'Seconds since the last heartbeat received from the member.')
+    ping = new_family('mongodb_member_ping_milliseconds', 'gauge', 'Heartbeat round trip time to the member.')
+    lag = new_family('mongodb_member_replication_lag_seconds', 'gauge', 'Seconds the member optime is behind the primary.')
+    issues = new_family('mongodb_heartbeat_issues', 'gauge', 'Members with a heartbeat older than 10 seconds or a heartbeat message.')
+
+    primary = next((member for member in status['members'] if member.get('stateStr') == 'PRIMARY'), None)
+    issue_count = 0
+    for member in status['members']:
+        # The state is a value of mongodb_member_state, as a label it would start a new series on every election
+        labels = {'set': status['set'], 'member': member['name']}
+        health['samples'].append((labels, member.get('health', 0)))
+        state['samples'].append((labels, member.get('state', -1)))
+        uptime['samples'].append((labels, member.get('uptime', 0)))
+        if member.get('pingMs') is not None:
+            ping['samples'].append((labels, member['pingMs']))
+        recv = member.get('lastHeartbeatRecv')
+        stale = False
+        if recv:
+            age = (now - recv).total_seconds()
+            heartbeat_age['samples'].append((labels, age))
+            stale = bool(member.get('lastHeartbeat')) and age > 10
+        if stale or member.get('lastHeartbeatMessage'):
+            issue_count += 1
+        if primary and member.get('optimeDate') and primary.get('optimeDate'):
+            lag['samples'].append((labels, max((primary['optimeDate'] - member['optimeDate']).total_seconds(), 0)))
+    issues['samples'].append(({'set': status['set']}, issue_count))
+    return [health, state, uptime, heartbeat_age, ping, lag, issues]
+
+def collect_oplog(client):
+    # Same sources as get_oplog_info in the summary tools
+    oplog = client.local['oplog.rs']
+    oplog_stats = client.local.command('collStats', 'oplog.rs')
+    oplog_start = oplog.find().sort('$natural', 1).limit(1).next()
+    oplog_end = oplog.find().sort('$natural', -1).limit(1).next()
+    window = (oplog_end['ts'].as_datetime() - oplog_start['ts'].as_datetime()).total_seconds()
+    election_date = next((member.get('electionDate') for member in client.admin.command('replSetGetStatus')['members']
+                          if member.get('stateStr') == 'PRIMARY'), None)
+
+    families = [
+        new_family('mongodb_oplog_storage_bytes', 'gauge', 'Storage size of the oplog.'),
+        new_family('mongodb_oplog_used_bytes', 'gauge', 'Data size of the oplog.'),
+        new_family('mongodb_oplog_window_seconds', 'gauge', 'Time between the first and the last oplog entry.'),
+        new_family('mongodb_last_election_timestamp_seconds', 'gauge', 'Unix time of the last election of the current primary.')
+    ]
+    families[0]['samples'].append(({}, oplog_stats['storageSize']))
+    families[1]['samples'].append(({}, oplog_stats['size']))
+    families[2]['samples'].append(({}, window))
+    if election_date:
+        families[3]['samples'].append(({}, election_date.replace(tzinfo=timezone.utc).timestamp()))
+    return families
+
+def collect_running_ops(client):
+    # Same counters as print_running_ops, exported raw so Prometheus can compute rates
+    server_status = client.admin.command('serverStatus')
+    opcounters = new_family('mongodb_opcounters_total', 'counter', 'Operations by type since the server started.')
+    for op in OPCOUNTERS:
+        opcounters['samples'].append(({'type': op}, server_status['opcounters'].get(op, 0)))
+    connections = new_family('mongodb_connections', 'gauge', 'Connections by state.')
+    for key in ('current', 'available', 'active'):
+        if key in server_status.get('connections', {}):
+            connections['samples'].append(({'state': key}, server_status['connections'][key]))
+    memory = new_family('mongodb_memory_bytes', 'gauge', 'Resident and virtual memory of the server process.')
+    for key in ('resident', 'virtual'):
+        if key in server_status.get('mem', {}):
+            memory['samples'].append(({'type': key}, server_status['mem'][key] * 1024 * 1024))
+    uptime = new_family('mongodb_uptime_seconds', 'gauge', 'Server uptime in seconds.')
+    uptime['samples'].append(({}, server_status.get('uptime', 0)))
+    return [opcounters, connections, memory, uptime]
+
+def collect_sizes(client):
+    # Same numbers as list_databases_and_collections in the size printers
+    families = {
+        'count': new_family('mongodb_collection_documents', 'gauge', 'Documents in the collection.'),
+        'size': new_family('mongodb_collection_data_bytes', 'gauge', 'Uncompressed data size of the collection.'),
+        'storageSize': new_family('mongodb_collection_storage_bytes', 'gauge', 'Storage size of the collection.'),
+        'totalIndexSize': new_family('mongodb_collection_index_bytes', 'gauge', 'Total size of the collection indexes.'),
+        'nindexes': new_family('mongodb_collection_indexes', 'gauge', 'Number of indexes on the collection.')
+    }
+    for db_name in client.list_database_names():
+        db = client[db_name]
+        for coll_name in db.list_collection_names(filter={'type': 'collection'}):
+            try:
+                coll_stats = db.command('collStats', coll_name)
+            except Exception:
+                continue
+            labels = {'database': db_name, 'collection': coll_name}
+            for key, family in families.items():
+                family['samples'].append((labels, coll_stats.get(key, 0)))
+    return list(families.values())
+
+COLLECTORS = {
+    'heartbeat': collect_heartbeat,
+    'oplog': collect_oplog,
+    'running_ops': collect_running_ops,
+    'sizes': collect_sizes
+}
+
+def new_cache(collectors):
+    return {'lock': threading.Lock(), 'parts': {name: '' for name in collectors}, 'status': {}, 'body': b''}
+
+def run_collector(client, cache, name):
+    started = time.time()
+    try:
+        text = render_families(COLLECTORS[name](client))
+        success = True
+    except Exception as e:
+        print(f"Error collecting {name} metrics: {e}", file=sys.stderr)
+        text = None
+        success = False
+    with cache['lock']:
+        # A failed collection keeps the last good values, up and the timestamp show it is stale
+        if success:
+            cache['parts'][name] = text
+            cache['status'][name] = {'up': 1, 'duration': time.time() - started, 'last_success': time.time()}
+        else:
+            previous = cache['status'].get(name, {})
+            cache['status'][name] = {'up': 0, 'duration': time.time() - started, 'last_success': previous.get('last_success', 0)}
+        cache['body'] = render_cache(cache).encode()
+
+def render_cache(cache):
+    up = new_family('mongodb_exporter_collector_up', 'gauge', 'Whether the last collection succeeded.')
+    duration = new_family('mongodb_exporter_collector_duration_seconds', 'gauge', 'Time the last collection took.')
+    last_success = new_family('mongodb_exporter_collector_last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful collection.')
+    for name, status in cache['status'].items():
+        up['samples'].append(({'collector': name}, status['up']))
+        duration['samples'].append(({'collector': name}, status['duration']))
+        last_success['samples'].append(({'collector': name}, status['last_success']))
+    return ''.join(cache['parts'].values()) + render_families([up, duration, last_success])
+
+def collector_loop(client, cache, name, interval, stop):
+    while not stop.is_set():
+        started = time.time()
+        run_collector(client, cache, name)
+        stop.wait(max(0, interval - (time.time() - started)))
+
+def start_collectors(client, cache, intervals, stop):
+    # One thread per collector, so a slow size sweep never delays the heartbeat metrics
+    threads = []
+    for name, interval in intervals.items():
+        thread = threading.Thread(target=collector_loop, args=(client, cache, name, interval, stop), name=f"collector-{name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def make_handler(cache):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Scrapes only read the cached body, they never reach the cluster
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = cache['body']
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve MongoDB heartbeat, oplog, operation counter and size metrics on a Prometheus /metrics endpoint.')
+    parser.add_argument('--host', default='localhost', help='MongoDB host')
+    parser.add_argument('--port', type=int, default=27017, help='MongoDB port')
+    parser.add_argument('--username', help='MongoDB username')
+    parser.add_argument('--password', help='MongoDB password')
+    parser.add_argument('--authdb', default='admin', help='MongoDB authentication database')
+    parser.add_argument('--listen-address', default='0.0.0.0', help='Address the HTTP server listens on (default: 0.0.0.0)')
+    parser.add_argument('--listen-port', type=int, default=9216, help='Port the HTTP server listens on (default: 9216)')
+    parser.add_argument('--collectors', default=','.join(COLLECTORS), help=f"Comma separated collectors to run (default: {','.join(COLLECTORS)})")
+    parser.add_argument('--interval', type=float, default=15, help='Seconds between heartbeat, oplog and running ops collections (default: 15)')
+    parser.add_argument('--size-interval', type=float, default=300, help='Seconds between size collections, which touch every collection (default: 300)')
+    parser.add_argument('--once', action='store_true', help='Collect once, print the metrics and exit')
+
+    args = parser.parse_args()
+
+    collectors = [name for name in args.collectors.split(',') if name]
+    unknown = [name for name in collectors if name not in COLLECTORS]
+    if unknown:
+        print(f"Unknown collectors: {', '.join(unknown)}. Available: {', '.join(COLLECTORS)}")
+        return
+
+    client = get_mongo_client(args.host, args.port, args.username, args.password, args.authdb)
+    cache = new_cache(collectors)
+
+    if args.once:
+        for name in collectors:
+            run_collector(client, cache, name)
+        print(cache['body'].decode(), end='')
+        client.close()
+        return
+
+    stop = threading.Event()
+    start_collectors(client, cache, {name: args.size_interval if name == 'sizes' else args.interval for name in collectors}, stop)
+    server = ThreadingHTTPServer((args.listen_address, args.listen_port), make_handler(cache))
+    print(f"Serving metrics on http://{args.listen_address}:{args.listen_port}/metrics at {datetime.now():%Y-%m-%d %H:%M:%S}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        client.close()
+
+if __name__ == '__main__':
+    main()
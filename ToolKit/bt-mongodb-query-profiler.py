@@ -1,7 +1,19 @@
 import argparse
+import gzip
+import hashlib
+import json
 import logging
-from pymongo import MongoClient, DESCENDING, ASCENDING
-from datetime import datetime
+import math
+import mmap
+import os
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
+from pymongo import MongoClient, CursorType, DESCENDING, ASCENDING
+from pymongo.errors import AutoReconnect, OperationFailure
+from datetime import datetime, timedelta, timezone
 import numpy as np
 
 def setup_logging(log_level):
@@ -26,8 +38,374 @@ def build_query(log_level):
 
     return base_query
 
-def run_mongo_query(db_name, username, password, auth_db, host, log_level, limit, order_by):
-    
+# Command fields that carry session or routing metadata rather than query shape
+IGNORED_COMMAND_FIELDS = {
+    'lsid', '$db', '$clusterTime', '$client', '$readPreference', '$configServerState',
+    'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern',
+    'comment', 'maxTimeMS', 'shardVersion', 'databaseVersion', 'clientOperationKey',
+    'mayBypassWriteBlocking', '$audit', '$replData', '$oplogQueryData'
+}
+
+METRICS = [
+    ('Exec Time ms', 'millis'),
+    ('Docs Scanned', 'docsExamined'),
+    ('Docs Returned', 'nreturned'),
+    ('Bytes recv', 'responseLength'),
+]
+
+# Percentiles are exact until a metric has more than EXACT_LIMIT values, then a log-bucketed
+# sketch with SKETCH_RELATIVE_ERROR accuracy and at most SKETCH_MAX_BUCKETS buckets takes over
+EXACT_LIMIT = 1000
+SKETCH_RELATIVE_ERROR = 0.01
+SKETCH_MAX_BUCKETS = 2048
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ERROR) / (1 - SKETCH_RELATIVE_ERROR)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+# Only the fields the columnar path needs are fetched from system.profile
+COLUMNAR_PROJECTION = {'_id': 0, 'ts': 1, 'ns': 1, 'op': 1, 'queryHash': 1, 'millis': 1, 'docsExamined': 1, 'nreturned': 1, 'responseLength': 1}
+
+# Profile entries have no _id, the ones stored at the watermark millisecond are told apart by these values
+WATERMARK_FIELDS = ['ns', 'op', 'queryHash', 'millis', 'docsExamined', 'nreturned', 'responseLength']
+
+# Initial number of rows allocated for the columnar arrays, doubled when full
+COLUMNAR_CHUNK_SIZE = 65536
+
+EPOCH = datetime(1970, 1, 1)
+
+# Slow operations are logged with this message by mongod 4.4+, other lines are skipped without parsing
+SLOW_QUERY_MARKER = b'"msg":"Slow query"'
+
+# Size of the byte ranges plain log files are split into for the worker processes
+LOG_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Commands --explain can run with executionStats verbosity
+EXPLAINABLE_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'findAndModify', 'update', 'delete'}
+
+# Command names mapped to the op values used in system.profile
+COMMAND_OPS = {
+    'find': 'query',
+    'getMore': 'getmore',
+    'insert': 'insert',
+    'update': 'update',
+    'delete': 'remove',
+    'findAndModify': 'command',
+}
+TS_MISSING = np.iinfo(np.int64).min
+
+# Rolling windows reported by --follow, kept as fixed-width time buckets per fingerprint
+FOLLOW_WINDOWS = [('1m', 60), ('5m', 300), ('15m', 900)]
+FOLLOW_BUCKET_SECS = 10
+
+REPORT_SORT_KEYS = {
+    'count': lambda fp: fp['count'],
+    'ratio': lambda fp: fingerprint_ratio(fp),
+    'query-time': lambda fp: fp['metrics']['millis']['total'],
+    'docs-scanned': lambda fp: fp['metrics']['docsExamined']['total'],
+    'docs-returned': lambda fp: fp['metrics']['nreturned']['total'],
+}
+
+def configure_sketch(relative_error, exact_limit):
+    global EXACT_LIMIT, SKETCH_RELATIVE_ERROR, SKETCH_GAMMA, SKETCH_LOG_GAMMA
+    if not 0 < relative_error < 1:
+        raise ValueError(f"Invalid sketch relative error: {relative_error}")
+    EXACT_LIMIT = exact_limit
+    SKETCH_RELATIVE_ERROR = relative_error
+    SKETCH_GAMMA = (1 + relative_error) / (1 - relative_error)
+    SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+def new_sketch():
+    return {'zero': 0, 'buckets': {}}
+
+def sketch_add(sketch, value, count=1):
+    if value <= 0:
+        sketch['zero'] += count
+        return
+    # Bucket i holds values in (gamma^(i-1), gamma^i], so any value is within the relative error of its bucket
+    index = math.ceil(math.log(value) / SKETCH_LOG_GAMMA)
+    buckets = sketch['buckets']
+    buckets[index] = buckets.get(index, 0) + count
+    if len(buckets) > SKETCH_MAX_BUCKETS:
+        collapse_sketch(sketch)
+
+def collapse_sketch(sketch):
+    # Fold the lowest buckets together, keeping the accuracy of the upper percentiles
+    buckets = sketch['buckets']
+    indexes = sorted(buckets)
+    excess = len(indexes) - SKETCH_MAX_BUCKETS
+    target = indexes[excess]
+    for index in indexes[:excess]:
+        buckets[target] += buckets.pop(index)
+
+def sketch_merge(target, source):
+    target['zero'] += source['zero']
+    buckets = target['buckets']
+    for index, count in source['buckets'].items():
+        buckets[index] = buckets.get(index, 0) + count
+    if len(buckets) > SKETCH_MAX_BUCKETS:
+        collapse_sketch(target)
+
+def sketch_quantile(sketch, q):
+    count = sketch['zero'] + sum(sketch['buckets'].values())
+    if not count:
+        return 0.0
+    rank = q * (count - 1)
+    seen = sketch['zero']
+    if rank < seen:
+        return 0.0
+    for index in sorted(sketch['buckets']):
+        seen += sketch['buckets'][index]
+        if rank < seen:
+            return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+    return 2 * SKETCH_GAMMA ** max(sketch['buckets']) / (SKETCH_GAMMA + 1)
+
+def samples_to_sketch(samples):
+    sketch = new_sketch()
+    for value in samples:
+        sketch_add(sketch, value)
+    return sketch
+
+def normalize_shape(value):
+    # Replace literals with '?', keep the structure and collapse repeated list elements
+    if isinstance(value, dict):
+        return {key: normalize_shape(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = normalize_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+def query_shape(entry):
+    query = entry.get('query')
+    if query is None:
+        query = {key: val for key, val in entry.get('command', {}).items() if key not in IGNORED_COMMAND_FIELDS}
+    return json.dumps(normalize_shape(query), sort_keys=True, separators=(',', ':'))
+
+def fingerprint_entry(entry):
+    ns = entry.get('ns', 'N/A')
+    op = entry.get('op', 'N/A')
+    shape = query_shape(entry)
+    return (ns, op, shape)
+
+def fingerprint_id(key):
+    return hashlib.md5('|'.join(key).encode('utf-8')).hexdigest()[:16].upper()
+
+def new_metric():
+    return {'total': 0, 'min': None, 'max': None, 'mean': 0.0, 'm2': 0.0, 'samples': [], 'sketch': None}
+
+def update_metric(metric, value, count):
+    metric['total'] += value
+    if metric['min'] is None or value < metric['min']:
+        metric['min'] = value
+    if metric['max'] is None or value > metric['max']:
+        metric['max'] = value
+
+    # Welford's online algorithm keeps mean and variance without the raw values
+    delta = value - metric['mean']
+    metric['mean'] += delta / count
+    metric['m2'] += delta * (value - metric['mean'])
+
+    if metric['sketch'] is not None:
+        sketch_add(metric['sketch'], value)
+        return
+    metric['samples'].append(value)
+    if len(metric['samples']) > EXACT_LIMIT:
+        metric['sketch'] = samples_to_sketch(metric['samples'])
+        metric['samples'] = []
+
+def new_fingerprint(key):
+    ns, op, shape = key
+    return {
+        'id': fingerprint_id(key),
+        'ns': ns,
+        'op': op,
+        'shape': shape,
+        'count': 0,
+        'first_seen': None,
+        'last_seen': None,
+        'metrics': {field: new_metric() for _, field in METRICS},
+        # One example command and its plan cache key, used by --explain
+        'sample': None,
+        'plan_key': None,
+    }
+
+def update_fingerprint(fingerprint, entry):
+    fingerprint['count'] += 1
+    count = fingerprint['count']
+
+    if fingerprint['sample'] is None and isinstance(entry.get('command'), dict):
+        fingerprint['sample'] = entry['command']
+        fingerprint['plan_key'] = entry.get('planCacheKey') or entry.get('queryHash')
+
+    ts = entry.get('ts')
+    if isinstance(ts, datetime):
+        if fingerprint['first_seen'] is None or ts < fingerprint['first_seen']:
+            fingerprint['first_seen'] = ts
+        if fingerprint['last_seen'] is None or ts > fingerprint['last_seen']:
+            fingerprint['last_seen'] = ts
+
+    for _, field in METRICS:
+        value = entry.get(field, 0) or 0
+        update_metric(fingerprint['metrics'][field], value, count)
+
+def aggregate_profile_entries(entries):
+    # Single streaming pass, memory grows with distinct shapes only
+    fingerprints = {}
+    for entry in entries:
+        key = fingerprint_entry(entry)
+        fingerprint = fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = fingerprints[key] = new_fingerprint(key)
+        update_fingerprint(fingerprint, entry)
+    return fingerprints
+
+def merge_metric(target, source, target_count, source_count):
+    count = target_count + source_count
+    if not source_count:
+        return
+    target['total'] += source['total']
+    if target['min'] is None or (source['min'] is not None and source['min'] < target['min']):
+        target['min'] = source['min']
+    if target['max'] is None or (source['max'] is not None and source['max'] > target['max']):
+        target['max'] = source['max']
+
+    # Chan's parallel variant of Welford's algorithm
+    delta = source['mean'] - target['mean']
+    target['mean'] += delta * source_count / count
+    target['m2'] += source['m2'] + delta * delta * target_count * source_count / count
+
+    # Sketches merge by adding bucket counts, exact values only stay exact while they fit
+    if target['sketch'] is None and source['sketch'] is None and len(target['samples']) + len(source['samples']) <= EXACT_LIMIT:
+        target['samples'] = target['samples'] + source['samples']
+        return
+    if target['sketch'] is None:
+        target['sketch'] = samples_to_sketch(target['samples'])
+        target['samples'] = []
+    if source['sketch'] is not None:
+        sketch_merge(target['sketch'], source['sketch'])
+    for value in source['samples']:
+        sketch_add(target['sketch'], value)
+
+def merge_fingerprint(target, source):
+    for _, field in METRICS:
+        merge_metric(target['metrics'][field], source['metrics'][field], target['count'], source['count'])
+    target['count'] += source['count']
+    if source['first_seen'] and (target['first_seen'] is None or source['first_seen'] < target['first_seen']):
+        target['first_seen'] = source['first_seen']
+    if source['last_seen'] and (target['last_seen'] is None or source['last_seen'] > target['last_seen']):
+        target['last_seen'] = source['last_seen']
+    if 'hosts' in source:
+        target['hosts'] = target.get('hosts', set()) | source['hosts']
+    if target.get('sample') is None and source.get('sample') is not None:
+        target['sample'] = source['sample']
+        target['plan_key'] = source.get('plan_key')
+
+def merge_fingerprints(target, source):
+    for key, fingerprint in source.items():
+        if key in target:
+            merge_fingerprint(target[key], fingerprint)
+        else:
+            target[key] = fingerprint
+    return target
+
+def fingerprint_ratio(fingerprint):
+    scanned = fingerprint['metrics']['docsExamined']['total']
+    returned = fingerprint['metrics']['nreturned']['total']
+    if returned:
+        return scanned / returned
+    return float(scanned)
+
+def metric_summary(metric, count):
+    samples = metric['samples']
+    if 'p95' in metric:
+        p95 = metric['p95']
+        median = metric['median']
+    elif metric.get('sketch') is not None:
+        # Bucket midpoints can fall just outside the observed range
+        low, high = metric['min'] or 0, metric['max'] or 0
+        p95 = min(max(sketch_quantile(metric['sketch'], 0.95), low), high)
+        median = min(max(sketch_quantile(metric['sketch'], 0.5), low), high)
+    elif samples:
+        p95 = float(np.percentile(samples, 95))
+        median = float(np.median(samples))
+    else:
+        p95 = median = 0.0
+    stddev = (metric['m2'] / count) ** 0.5 if count else 0.0
+    return {
+        'total': metric['total'],
+        'min': metric['min'] or 0,
+        'max': metric['max'] or 0,
+        'avg': metric['mean'],
+        '95%': p95,
+        'stddev': stddev,
+        'median': median,
+    }
+
+def format_ts(ts):
+    if isinstance(ts, datetime):
+        return ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    return 'N/A'
+
+def sort_fingerprints(fingerprints, order_by):
+    ordered = list(fingerprints.values())
+    fields = [field for field in order_by.split(',') if field] if order_by else ['-query-time']
+    for field in reversed(fields):
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        if name not in REPORT_SORT_KEYS:
+            logging.warning(f"Unknown report sort field: {name}")
+            continue
+        ordered.sort(key=REPORT_SORT_KEYS[name], reverse=descending)
+    return ordered
+
+def print_fingerprint_report(fingerprints, order_by, limit):
+    if not fingerprints:
+        logging.warning("No data found")
+        return
+
+    total_count = sum(fp['count'] for fp in fingerprints.values())
+    totals = {field: sum(fp['metrics'][field]['total'] for fp in fingerprints.values()) for _, field in METRICS}
+    first_seen = [fp['first_seen'] for fp in fingerprints.values() if fp['first_seen']]
+    last_seen = [fp['last_seen'] for fp in fingerprints.values() if fp['last_seen']]
+    if first_seen and last_seen:
+        window_secs = (max(last_seen) - min(first_seen)).total_seconds()
+    else:
+        window_secs = 0
+
+    ordered = sort_fingerprints(fingerprints, order_by)
+    if limit:
+        ordered = ordered[:limit]
+
+    for i, fingerprint in enumerate(ordered):
+        count = fingerprint['count']
+        qps = count / window_secs if window_secs > 0 else 0.0
+
+        print(f"# Query {i+1}:  {qps:.2f} QPS, ID {fingerprint['id']}")
+        print(f"# Ratio    {fingerprint_ratio(fingerprint):.2f}  (docs scanned/returned)")
+        print(f"# Time range: {format_ts(fingerprint['first_seen'])} to {format_ts(fingerprint['last_seen'])}")
+        print("# Attribute            pct     total        min         max        avg         95%        stddev      median")
+        print("# ==================   ===   ========    ========    ========    ========    ========     =======    ========")
+        print(f"# {'Count':<20} {count * 100 // total_count:>3}   {count:>8}")
+        for label, field in METRICS:
+            summary = metric_summary(fingerprint['metrics'][field], count)
+            pct = int(summary['total'] * 100 / totals[field]) if totals[field] else 0
+            print(f"# {label:<20} {pct:>3}   {summary['total']:>8.2f}    {summary['min']:>8.2f}    {summary['max']:>8.2f}    "
+                  f"{summary['avg']:>8.2f}    {summary['95%']:>8.2f}     {summary['stddev']:>7.2f}    {summary['median']:>8.2f}")
+        print("# String:")
+        print(f"# Namespaces          {fingerprint['ns']}")
+        print(f"# Operation           {fingerprint['op']}")
+        if fingerprint.get('hosts'):
+            print(f"# Hosts               {', '.join(sorted(fingerprint['hosts']))}")
+        print(f"# Fingerprint         {fingerprint['shape']}\n")
+
+def report_order_fields(order_by):
+    if not order_by:
+        return ''
+    return ','.join(field for field in order_by.split(',') if field.lstrip('-') in REPORT_SORT_KEYS)
+
+def get_mongo_client(username, password, auth_db, host, direct=False):
     if username and password:
         uri = f"mongodb://{username}:{password}@{host}/{auth_db}"
     else:
@@ -35,19 +413,206 @@ def run_mongo_query(db_name, username, password, auth_db, host, log_level, limit
     
     logging.info(f"Connecting to MongoDB with URI: {uri}")
     
-    
-    client = MongoClient(uri)
+    if direct:
+        return MongoClient(uri, directConnection=True)
+    return MongoClient(uri)
+
+def build_profile_pipeline(query, with_percentiles):
+    group = {
+        '_id': {'ns': '$ns', 'op': '$op', 'queryHash': '$queryHash'},
+        'count': {'$sum': 1},
+        'first_seen': {'$min': '$ts'},
+        'last_seen': {'$max': '$ts'},
+        'command': {'$first': {'$ifNull': ['$query', '$command']}},
+    }
+    for _, field in METRICS:
+        value = {'$ifNull': [f'${field}', 0]}
+        group[f'{field}_total'] = {'$sum': value}
+        group[f'{field}_min'] = {'$min': value}
+        group[f'{field}_max'] = {'$max': value}
+        group[f'{field}_avg'] = {'$avg': value}
+        group[f'{field}_stddev'] = {'$stdDevPop': value}
+        if with_percentiles:
+            group[f'{field}_pct'] = {'$percentile': {'input': value, 'p': [0.5, 0.95], 'method': 'approximate'}}
+
+    return [{'$match': query}, {'$group': group}]
+
+def fingerprint_from_group(row):
+    group_id = row['_id']
+    command = row.get('command') or {}
+    if isinstance(command, dict):
+        command = {key: val for key, val in command.items() if key not in IGNORED_COMMAND_FIELDS}
+    shape = json.dumps(normalize_shape(command), sort_keys=True, separators=(',', ':'))
+    key = (group_id.get('ns') or 'N/A', group_id.get('op') or 'N/A', shape)
+
+    fingerprint = new_fingerprint(key)
+    if group_id.get('queryHash'):
+        fingerprint['id'] = group_id['queryHash']
+        fingerprint['plan_key'] = group_id['queryHash']
+    if isinstance(row.get('command'), dict):
+        fingerprint['sample'] = row['command']
+    fingerprint['count'] = row['count']
+    fingerprint['first_seen'] = row.get('first_seen')
+    fingerprint['last_seen'] = row.get('last_seen')
+
+    for _, field in METRICS:
+        stddev = row.get(f'{field}_stddev') or 0.0
+        metric = fingerprint['metrics'][field]
+        metric['total'] = row.get(f'{field}_total', 0)
+        metric['min'] = row.get(f'{field}_min', 0)
+        metric['max'] = row.get(f'{field}_max', 0)
+        metric['mean'] = row.get(f'{field}_avg') or 0.0
+        metric['m2'] = stddev * stddev * row['count']
+        if f'{field}_pct' in row:
+            metric['median'], metric['p95'] = row[f'{field}_pct']
+    return fingerprint
+
+def aggregate_profile_on_server(client, profile_collection, query):
+    # $percentile is only available from MongoDB 7.0
+    version = client.server_info().get('versionArray', [0])
+    with_percentiles = version[0] >= 7
+    if not with_percentiles:
+        logging.info("Server does not support $percentile, 95% and median columns will be 0")
+
+    pipeline = build_profile_pipeline(query, with_percentiles)
+    logging.debug(f"Pipeline: {pipeline}")
+
+    fingerprints = {}
+    for row in profile_collection.aggregate(pipeline, allowDiskUse=True):
+        fingerprint = fingerprint_from_group(row)
+        # Entries without a queryHash can share a group key but not a shape
+        key = (fingerprint['ns'], fingerprint['op'], fingerprint['id'], fingerprint['shape'])
+        fingerprints[key] = fingerprint
+    return fingerprints
+
+def grow_column(column, size):
+    grown = np.empty(size, dtype=column.dtype)
+    grown[:len(column)] = column
+    return grown
+
+def read_profile_columns(cursor):
+    # Fill typed arrays row by row, the per-row cost is 4 bytes of group code plus 8 bytes per column
+    keys = {}
+    size = COLUMNAR_CHUNK_SIZE
+    codes = np.empty(size, dtype=np.int32)
+    timestamps = np.empty(size, dtype=np.int64)
+    values = {field: np.empty(size, dtype=np.float64) for _, field in METRICS}
+
+    n = 0
+    for entry in cursor:
+        if n == size:
+            size *= 2
+            codes = grow_column(codes, size)
+            timestamps = grow_column(timestamps, size)
+            values = {field: grow_column(column, size) for field, column in values.items()}
+
+        key = (entry.get('ns', 'N/A'), entry.get('op', 'N/A'), entry.get('queryHash'))
+        code = keys.get(key)
+        if code is None:
+            code = keys[key] = len(keys)
+        codes[n] = code
+
+        ts = entry.get('ts')
+        if isinstance(ts, datetime):
+            timestamps[n] = (ts - EPOCH) // timedelta(milliseconds=1)
+        else:
+            timestamps[n] = TS_MISSING
+
+        for field, column in values.items():
+            column[n] = entry.get(field, 0) or 0
+        n += 1
+
+    return list(keys), codes[:n], timestamps[:n], {field: column[:n] for field, column in values.items()}
+
+def grouped_percentile(sorted_values, starts, counts, p):
+    # Linear interpolation between closest ranks, same as np.percentile's default
+    position = starts + (counts - 1) * p
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def summarize_columns(keys, codes, timestamps, values):
+    if len(codes) == 0:
+        return {}
+
+    # Bring the rows of each group together, then reduce every group in one call per statistic
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    counts = np.diff(np.r_[starts, len(codes)])
+    group_codes = sorted_codes[starts]
+
+    sorted_ts = timestamps[order]
+    valid_ts = sorted_ts != TS_MISSING
+    first_seen = np.minimum.reduceat(np.where(valid_ts, sorted_ts, np.iinfo(np.int64).max), starts)
+    last_seen = np.maximum.reduceat(sorted_ts, starts)
+    has_ts = np.logical_or.reduceat(valid_ts, starts)
+
+    stats = {}
+    for field, column in values.items():
+        grouped = column[order]
+        total = np.add.reduceat(grouped, starts)
+        mean = total / counts
+        deviation = grouped - np.repeat(mean, counts)
+        within_group = np.lexsort((column, codes))
+        stats[field] = {
+            'total': total,
+            'min': np.minimum.reduceat(grouped, starts),
+            'max': np.maximum.reduceat(grouped, starts),
+            'mean': mean,
+            'm2': np.add.reduceat(deviation * deviation, starts),
+            'p95': grouped_percentile(column[within_group], starts, counts, 0.95),
+            'median': grouped_percentile(column[within_group], starts, counts, 0.5),
+        }
+
+    fingerprints = {}
+    for i, code in enumerate(group_codes):
+        ns, op, query_hash = keys[code]
+        shape = f"queryHash {query_hash}" if query_hash else 'N/A'
+        fingerprint = new_fingerprint((ns, op, shape))
+        if query_hash:
+            fingerprint['id'] = query_hash
+        fingerprint['count'] = int(counts[i])
+        if has_ts[i]:
+            fingerprint['first_seen'] = EPOCH + timedelta(milliseconds=int(first_seen[i]))
+            fingerprint['last_seen'] = EPOCH + timedelta(milliseconds=int(last_seen[i]))
+        for field, field_stats in stats.items():
+            metric = fingerprint['metrics'][field]
+            for stat, column in field_stats.items():
+                metric[stat] = float(column[i])
+        fingerprints[keys[code]] = fingerprint
+    return fingerprints
+
+def run_mongo_query(db_name, username, password, auth_db, host, log_level, limit, order_by, server_side=False, columnar=False, batch_size=10000, store=None, explain=None):
+    client = get_mongo_client(username, password, auth_db, host)
     db = client[db_name]
     profile_collection = db.system.profile
 
     # Build query
     query = build_query(log_level)
+    watermark = load_watermark(store, host, db_name) if store else None
+    if watermark:
+        logging.info(f"Resuming {db_name}.system.profile on {host} from {format_ts(watermark['ts'])}")
+        query = watermark_query(query, watermark)
     logging.debug(f"Query: {query}")
+
+    report_order = report_order_fields(order_by)
+
+    if server_side:
+        fingerprints = aggregate_profile_on_server(client, profile_collection, query)
+        logging.info(f"Number of profile records found: {sum(fp['count'] for fp in fingerprints.values())}")
+        logging.info(f"Number of distinct fingerprints: {len(fingerprints)}")
+        print_fingerprint_report(fingerprints, report_order, limit)
+        if explain:
+            explain_top_fingerprints(client, fingerprints, report_order, explain)
+        return
     
-    # Sorting
+    # Fields that are not report columns are pushed down as a server side sort
     sort_order = []
     if order_by:
         for field in order_by.split(','):
+            if field.lstrip('-') in REPORT_SORT_KEYS:
+                continue
             if field.startswith('-'):
                 sort_order.append((field[1:], DESCENDING))
             else:
@@ -56,104 +621,834 @@ def run_mongo_query(db_name, username, password, auth_db, host, log_level, limit
     logging.debug(f"Using sort order: {sort_order}")
     
     # Retrieve the profiling data
+    projection = COLUMNAR_PROJECTION if columnar else None
+    cursor = profile_collection.find(query, projection).batch_size(batch_size)
     if sort_order:
-        cursor = profile_collection.find(query).sort(sort_order)
+        cursor = cursor.sort(sort_order)
+    watermark = new_watermark(watermark)
+    entries = track_watermark(cursor, watermark)
+
+    if columnar:
+        fingerprints = summarize_columns(*read_profile_columns(entries))
     else:
-        cursor = profile_collection.find(query)
-    
-    if limit:
-        cursor = cursor.limit(limit)
-    
-    profile_data = list(cursor)
-    logging.info(f"Number of profile records found: {len(profile_data)}")
+        fingerprints = aggregate_profile_entries(entries)
+    logging.info(f"Number of profile records found: {sum(fp['count'] for fp in fingerprints.values())}")
+    logging.info(f"Number of distinct fingerprints: {len(fingerprints)}")
 
-    if not profile_data:
-        logging.warning("No data found")
+    if store:
+        run_id = save_run(store, f"{host}/{db_name}", fingerprints)
+        save_watermark(store, host, db_name, watermark)
+        logging.info(f"Saved run {run_id} to the digest store")
+
+    print_fingerprint_report(fingerprints, report_order, limit)
+    if explain:
+        explain_top_fingerprints(client, fingerprints, report_order, explain)
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def epoch_secs(ts):
+    return (ts - EPOCH).total_seconds()
+
+def new_follow_fingerprint(key):
+    ns, op, shape = key
+    return {
+        'id': fingerprint_id(key),
+        'ns': ns,
+        'op': op,
+        'shape': shape,
+        # Each bucket is [start_secs, count, total_millis, max_millis, millis_sketch]
+        'buckets': deque(),
+    }
+
+def expire_buckets(fingerprint, now_secs):
+    horizon = now_secs - FOLLOW_WINDOWS[-1][1]
+    buckets = fingerprint['buckets']
+    while buckets and buckets[0][0] + FOLLOW_BUCKET_SECS <= horizon:
+        buckets.popleft()
+
+def record_follow_entry(fingerprints, entry, max_fingerprints):
+    key = fingerprint_entry(entry)
+    fingerprint = fingerprints.get(key)
+    if fingerprint is None:
+        fingerprint = fingerprints[key] = new_follow_fingerprint(key)
+        # Least recently seen shapes are dropped first so memory stays fixed
+        while len(fingerprints) > max_fingerprints:
+            fingerprints.popitem(last=False)
+    else:
+        fingerprints.move_to_end(key)
+
+    ts = entry.get('ts')
+    secs = epoch_secs(ts) if isinstance(ts, datetime) else epoch_secs(utc_now())
+    bucket_start = int(secs // FOLLOW_BUCKET_SECS) * FOLLOW_BUCKET_SECS
+    millis = entry.get('millis', 0) or 0
+
+    buckets = fingerprint['buckets']
+    bucket = None
+    if buckets and buckets[-1][0] == bucket_start:
+        bucket = buckets[-1]
+    elif not buckets or buckets[-1][0] < bucket_start:
+        bucket = [bucket_start, 0, 0, 0, new_sketch()]
+        buckets.append(bucket)
+    else:
+        # Late entry, fold it into the matching older bucket if it is still kept
+        for kept in buckets:
+            if kept[0] == bucket_start:
+                bucket = kept
+                break
+    if bucket is not None:
+        bucket[1] += 1
+        bucket[2] += millis
+        bucket[3] = max(bucket[3], millis)
+        sketch_add(bucket[4], millis)
+    expire_buckets(fingerprint, secs)
+
+def follow_window_stats(fingerprint, now_secs, started_secs):
+    stats = []
+    for _, window_secs in FOLLOW_WINDOWS:
+        # Until a window has filled, QPS is over the time actually followed
+        elapsed = max(min(window_secs, now_secs - started_secs), 1)
+        count = total = peak = 0
+        sketch = new_sketch()
+        for bucket_start, bucket_count, bucket_total, bucket_max, bucket_sketch in fingerprint['buckets']:
+            if bucket_start + FOLLOW_BUCKET_SECS > now_secs - window_secs:
+                count += bucket_count
+                total += bucket_total
+                peak = max(peak, bucket_max)
+                sketch_merge(sketch, bucket_sketch)
+        stats.append({'count': count, 'total': total, 'max': peak, 'qps': count / elapsed,
+                      'avg': total / count if count else 0.0, 'p95': min(sketch_quantile(sketch, 0.95), peak)})
+    return stats
+
+def print_follow_report(fingerprints, top, started_secs):
+    now = utc_now()
+    now_secs = epoch_secs(now)
+
+    rows = []
+    for key in list(fingerprints):
+        fingerprint = fingerprints[key]
+        expire_buckets(fingerprint, now_secs)
+        if not fingerprint['buckets']:
+            del fingerprints[key]
+            continue
+        rows.append((fingerprint, follow_window_stats(fingerprint, now_secs, started_secs)))
+
+    # Top offenders are the shapes with the most execution time in the shortest window
+    rows.sort(key=lambda row: (row[1][0]['total'], row[1][-1]['total']), reverse=True)
+
+    labels = [label for label, _ in FOLLOW_WINDOWS]
+    print(f"# Top offenders at {format_ts(now)} ({len(fingerprints)} active fingerprints)")
+    print(f"# {'ID':<16}   " + '   '.join(f"{'QPS ' + label:>9}" for label in labels) + '   '
+          + '   '.join(f"{'avg ms ' + label:>10}" for label in labels) + '   '
+          + '   '.join(f"{'95% ms ' + label:>10}" for label in labels) + f"   {'max ms':>9}   Namespace / Operation")
+    for fingerprint, stats in rows[:top]:
+        print(f"# {fingerprint['id']:<16}   " + '   '.join(f"{window['qps']:>9.2f}" for window in stats) + '   '
+              + '   '.join(f"{window['avg']:>10.2f}" for window in stats) + '   '
+              + '   '.join(f"{window['p95']:>10.2f}" for window in stats) + f"   {stats[-1]['max']:>9.2f}   {fingerprint['ns']} {fingerprint['op']}")
+    for fingerprint, _ in rows[:top]:
+        print(f"# {fingerprint['id']}  {fingerprint['shape']}")
+    print()
+
+def follow_profile(client, db_name, log_level, since, refresh, top, max_fingerprints):
+    profile_collection = client[db_name].system.profile
+    query = build_query(log_level)
+    # Reopened cursors resume at the last seen ts, entries already recorded in that millisecond are excluded
+    watermark = {'ts': since or utc_now(), 'entries': []}
+    started_secs = epoch_secs(watermark['ts'])
+    fingerprints = OrderedDict()
+    next_report = time.monotonic() + refresh
+
+    logging.info(f"Following {db_name}.system.profile from {format_ts(watermark['ts'])}")
+    while True:
+        cursor = profile_collection.find(watermark_query(query, watermark), cursor_type=CursorType.TAILABLE_AWAIT)
+        cursor = cursor.max_await_time_ms(min(1000, int(refresh * 1000)))
+        try:
+            while cursor.alive:
+                for entry in cursor:
+                    record_follow_entry(fingerprints, entry, max_fingerprints)
+                    advance_watermark(watermark, entry)
+                    if time.monotonic() >= next_report:
+                        break
+                if time.monotonic() >= next_report:
+                    print_follow_report(fingerprints, top, started_secs)
+                    next_report = time.monotonic() + refresh
+        except (AutoReconnect, OperationFailure) as e:
+            logging.warning(f"Profile cursor lost, resuming from {format_ts(watermark['ts'])}: {e}")
+        finally:
+            cursor.close()
+
+        # A dead cursor (e.g. empty collection or capped position lost) is reopened from the last seen ts
+        time.sleep(1)
+
+def get_replica_set_members(seed_client):
+    status = seed_client.admin.command('replSetGetStatus')
+    return [member['name'] for member in status['members'] if member.get('stateStr') in ('PRIMARY', 'SECONDARY')]
+
+def discover_profile_nodes(client, host, connect, pool):
+    # Profiler data lives on every data bearing mongod, so list all shard and replica set members
+    is_master = client.admin.command('isMaster')
+    if is_master.get('msg') == 'isdbgrid':
+        seeds = []
+        for shard in client.admin.command('listShards')['shards']:
+            hosts = shard['host'].split('/', 1)[-1]
+            seeds.append(hosts.split(',')[0])
+    elif 'setName' in is_master:
+        seeds = [is_master.get('primary') or is_master['me']]
+    else:
+        return [host]
+
+    def members_of(seed):
+        seed_client = connect(seed)
+        try:
+            return get_replica_set_members(seed_client)
+        except Exception as e:
+            logging.warning(f"Could not get replica set members from {seed}, using it alone: {e}")
+            return [seed]
+        finally:
+            seed_client.close()
+
+    nodes = []
+    for members in pool.map(members_of, seeds):
+        nodes.extend(member for member in members if member not in nodes)
+    return nodes
+
+def collect_node_profile(client, node, db_name, query, batch_size, watermark=None):
+    if watermark:
+        query = watermark_query(query, watermark)
+    cursor = client[db_name].system.profile.find(query).batch_size(batch_size)
+    watermark = new_watermark(watermark)
+    fingerprints = aggregate_profile_entries(track_watermark(cursor, watermark))
+    for fingerprint in fingerprints.values():
+        fingerprint['hosts'] = {node}
+    return fingerprints, watermark
+
+def list_profiled_databases(client):
+    return [db for db in client.list_database_names() if db not in ('admin', 'local', 'config')]
+
+def safe_list_databases(client, node):
+    try:
+        return list_profiled_databases(client)
+    except Exception as e:
+        logging.warning(f"Failed to list databases on {node}: {e}")
+        return []
+
+def run_cluster_query(db_names, username, password, auth_db, host, log_level, limit, order_by, batch_size, workers, store=None, explain=None):
+    query = build_query(log_level)
+    logging.debug(f"Query: {query}")
+
+    def connect(node):
+        return get_mongo_client(username, password, auth_db, node, direct=True)
+
+    client = get_mongo_client(username, password, auth_db, host)
+    fingerprints = {}
+    clients = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            nodes = discover_profile_nodes(client, host, connect, pool)
+            logging.info(f"Collecting profile data from {len(nodes)} node(s): {', '.join(nodes)}")
+
+            # Clients connect lazily, so one per node is created up front and shared by its tasks
+            clients = {node: connect(node) for node in nodes}
+            if db_names:
+                node_dbs = {node: db_names for node in nodes}
+            else:
+                node_dbs = dict(zip(nodes, pool.map(lambda node: safe_list_databases(clients[node], node), nodes)))
+
+            tasks = {}
+            for node, names in node_dbs.items():
+                for db_name in names:
+                    watermark = load_watermark(store, node, db_name) if store else None
+                    future = pool.submit(collect_node_profile, clients[node], node, db_name, query, batch_size, watermark)
+                    tasks[future] = (node, db_name)
+
+            for future in as_completed(tasks):
+                node, db_name = tasks[future]
+                try:
+                    result, watermark = future.result()
+                except Exception as e:
+                    logging.warning(f"Failed to read {db_name}.system.profile on {node}: {e}")
+                    continue
+                if store:
+                    save_watermark(store, node, db_name, watermark)
+                merge_fingerprints(fingerprints, result)
+
+        logging.info(f"Number of profile records found: {sum(fp['count'] for fp in fingerprints.values())}")
+        logging.info(f"Number of distinct fingerprints: {len(fingerprints)}")
+
+        if store:
+            run_id = save_run(store, f"cluster {host}", fingerprints)
+            logging.info(f"Saved run {run_id} to the digest store")
+
+        print_fingerprint_report(fingerprints, report_order_fields(order_by), limit)
+        if explain:
+            # Explain through the entry point so mongos routes each shape to its shards
+            explain_top_fingerprints(client, fingerprints, report_order_fields(order_by), explain)
+    finally:
+        for node_client in clients.values():
+            node_client.close()
+        client.close()
+
+def entry_matches_query(entry, query):
+    # Evaluates the filters produced by build_query against a profile-like entry
+    for field, condition in query.items():
+        value = entry.get(field)
+        if '$nin' in condition and value in condition['$nin']:
+            return False
+        if '$exists' in condition and (value is not None) != condition['$exists']:
+            return False
+        if '$gte' in condition and (value is None or value < condition['$gte']):
+            return False
+    return True
+
+def parse_log_date(value):
+    if isinstance(value, dict):
+        value = value.get('$date')
+    if not isinstance(value, str):
+        return None
+    try:
+        return parse_utc_ts(value)
+    except ValueError:
+        return None
+
+def parse_utc_ts(text):
+    ts = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    # pymongo returns naive UTC datetimes for system.profile, match them
+    if ts.tzinfo:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def log_line_to_entry(line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if record.get('msg') != 'Slow query':
+        return None
+
+    attr = record.get('attr', {})
+    command = attr.get('command', {})
+    op = attr.get('type', 'command')
+    if op == 'command' and command:
+        op = COMMAND_OPS.get(next(iter(command)), 'command')
+
+    entry = {
+        'ts': parse_log_date(record.get('t')),
+        'ns': attr.get('ns', 'N/A'),
+        'op': op,
+        'command': command,
+        'millis': attr.get('durationMillis', 0),
+        'docsExamined': attr.get('docsExamined', 0),
+        'nreturned': attr.get('nreturned', 0),
+        'responseLength': attr.get('reslen', 0),
+    }
+    if 'queryHash' in attr:
+        entry['queryHash'] = attr['queryHash']
+    if 'planCacheKey' in attr:
+        entry['planCacheKey'] = attr['planCacheKey']
+    if 'errMsg' in attr or 'errCode' in attr:
+        entry['err'] = attr.get('errMsg', attr.get('errCode'))
+    return entry
+
+def aggregate_log_lines(lines, query, db_name):
+    fingerprints = {}
+    for line in lines:
+        if SLOW_QUERY_MARKER not in line:
+            continue
+        entry = log_line_to_entry(line)
+        if entry is None or not entry_matches_query(entry, query):
+            continue
+        if db_name and not entry['ns'].startswith(f"{db_name}."):
+            continue
+        key = fingerprint_entry(entry)
+        fingerprint = fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = fingerprints[key] = new_fingerprint(key)
+        update_fingerprint(fingerprint, entry)
+    return fingerprints
+
+def iter_marked_lines(mapped, start, end):
+    # Jump from marker to marker instead of walking every line, only lines starting inside [start, end) are ours
+    pos = start
+    while pos < end:
+        hit = mapped.find(SLOW_QUERY_MARKER, pos)
+        if hit == -1:
+            return
+        line_start = mapped.rfind(b'\n', 0, hit) + 1
+        if line_start >= end:
+            return
+        line_end = mapped.find(b'\n', hit)
+        if line_end == -1:
+            line_end = len(mapped)
+        yield mapped[line_start:line_end]
+        pos = line_end + 1
+
+def scan_log_task(task):
+    path, start, end, query, db_name, sketch_config = task
+    # Spawned workers don't inherit the settings applied in main
+    configure_sketch(*sketch_config)
+    if start is None:
+        with gzip.open(path, 'rb') as log_file:
+            return aggregate_log_lines(log_file, query, db_name)
+
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        # A range that starts mid-line leaves that line to the previous range
+        if start > 0 and mapped[start - 1:start] != b'\n':
+            newline = mapped.find(b'\n', start)
+            start = len(mapped) if newline == -1 else newline + 1
+        return aggregate_log_lines(iter_marked_lines(mapped, start, end), query, db_name)
+
+def build_log_tasks(paths, query, db_name):
+    sketch_config = (SKETCH_RELATIVE_ERROR, EXACT_LIMIT)
+    tasks = []
+    for path in paths:
+        if path.endswith('.gz'):
+            # Gzip streams can't be split, each file gets a worker of its own
+            tasks.append((path, None, None, query, db_name, sketch_config))
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, size, LOG_CHUNK_SIZE):
+            tasks.append((path, start, min(start + LOG_CHUNK_SIZE, size), query, db_name, sketch_config))
+    return tasks
+
+def run_log_analysis(paths, db_name, log_level, limit, order_by, workers):
+    query = build_query(log_level)
+    logging.debug(f"Query: {query}")
+
+    tasks = build_log_tasks(paths, query, db_name)
+    logging.info(f"Scanning {len(paths)} log file(s) in {len(tasks)} chunk(s) with {workers} worker(s)")
+
+    fingerprints = {}
+    if workers > 1 and len(tasks) > 1:
+        with Pool(min(workers, len(tasks))) as pool:
+            for result in pool.imap_unordered(scan_log_task, tasks):
+                merge_fingerprints(fingerprints, result)
+    else:
+        for task in tasks:
+            merge_fingerprints(fingerprints, scan_log_task(task))
+
+    logging.info(f"Number of slow query entries found: {sum(fp['count'] for fp in fingerprints.values())}")
+    logging.info(f"Number of distinct fingerprints: {len(fingerprints)}")
+
+    print_fingerprint_report(fingerprints, report_order_fields(order_by), limit)
+
+def explainable_command(fingerprint):
+    sample = fingerprint.get('sample')
+    if not sample or next(iter(sample)) not in EXPLAINABLE_COMMANDS:
+        return None
+    return {key: val for key, val in sample.items() if key not in IGNORED_COMMAND_FIELDS}
+
+def collect_plan_stages(node, stages):
+    # Walk the winning plan only, rejected candidates don't say anything about this run
+    if isinstance(node, dict):
+        if 'stage' in node:
+            stages.append(node)
+        for key, value in node.items():
+            if key not in ('rejectedPlans', 'allPlansExecution', 'executionStages'):
+                collect_plan_stages(value, stages)
+    elif isinstance(node, list):
+        for item in node:
+            collect_plan_stages(item, stages)
+    return stages
+
+def find_execution_stats(node):
+    if isinstance(node, dict):
+        if 'totalKeysExamined' in node and 'nReturned' in node:
+            return node
+        for value in node.values():
+            found = find_execution_stats(value)
+            if found:
+                return found
+    elif isinstance(node, list):
+        for item in node:
+            found = find_execution_stats(item)
+            if found:
+                return found
+    return None
+
+def analyze_explain(explain, ratio_threshold):
+    stages = collect_plan_stages(explain.get('queryPlanner', explain), [])
+    plan = ' <- '.join(f"{stage['stage']}({stage['indexName']})" if stage.get('indexName') else stage['stage'] for stage in stages)
+
+    findings = []
+    if any(stage['stage'] == 'COLLSCAN' for stage in stages):
+        findings.append('COLLSCAN')
+    # A SORT stage means the order is not provided by an index and is computed in memory
+    if any(stage['stage'] == 'SORT' for stage in stages):
+        findings.append('SORT not index-backed')
+
+    stats = find_execution_stats(explain)
+    keys_examined = docs_examined = returned = 0
+    if stats:
+        keys_examined = stats.get('totalKeysExamined', 0)
+        docs_examined = stats.get('totalDocsExamined', 0)
+        returned = stats.get('nReturned', 0)
+        ratio = keys_examined / max(returned, 1)
+        if ratio > ratio_threshold:
+            findings.append(f"keysExamined/nreturned {ratio:.1f}")
+
+    return {
+        'plan': plan or 'N/A',
+        'findings': findings,
+        'keysExamined': keys_examined,
+        'docsExamined': docs_examined,
+        'nreturned': returned,
+        'explained_at': ts_to_text(utc_now()),
+    }
+
+def load_explain_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as cache_file:
+        return json.load(cache_file)
+
+def save_explain_cache(path, cache):
+    if not path:
         return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, path)
 
-    
-    exec_times = []
-    docs_scanned = []
-    docs_returned = []
-    bytes_recv = []
-    timestamps = []
-
-    for entry in profile_data:
-        exec_times.append(entry.get('millis', 0))
-        docs_scanned.append(entry.get('docsExamined', 0))
-        docs_returned.append(entry.get('nreturned', 0))
-        bytes_recv.append(entry.get('responseLength', 0))
-        timestamps.append(entry.get('ts'))
+def explain_fingerprint(client, fingerprint, ratio_threshold):
+    command = explainable_command(fingerprint)
+    db_name = fingerprint['ns'].split('.', 1)[0]
+    explain = client[db_name].command('explain', command, verbosity='executionStats')
+    return analyze_explain(explain, ratio_threshold)
 
-    
-    total_docs = len(profile_data)
-    total_exec_time = sum(exec_times)
-    total_docs_scanned = sum(docs_scanned)
-    total_docs_returned = sum(docs_returned)
-    total_bytes_recv = sum(bytes_recv)
-    avg_exec_time = np.mean(exec_times)
-    avg_docs_scanned = np.mean(docs_scanned)
-    avg_docs_returned = np.mean(docs_returned)
-    avg_bytes_recv = np.mean(bytes_recv)
-    stddev_exec_time = np.std(exec_times)
-    stddev_docs_scanned = np.std(docs_scanned)
-    stddev_docs_returned = np.std(docs_returned)
-    stddev_bytes_recv = np.std(bytes_recv)
-
-    # Print detailed statistics for each query
-    for i, entry in enumerate(profile_data):
-        query_id = entry.get('opid', 'N/A')
-        if query_id == 'N/A':
-            command = entry.get('command', {})
-            if 'lsid' in command and 'id' in command['lsid']:
-                query_id = command['lsid']['id'].hex()
-            elif 'txnNumber' in command:
-                query_id = str(command['txnNumber'])
-            elif 'queryHash' in command:
-                query_id = str(command['queryHash'])
-        
-        start_time = entry.get('ts', 'N/A')
-        if isinstance(start_time, datetime):
-            start_time_str = start_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+def explain_top_fingerprints(client, fingerprints, order_by, options):
+    top = [fp for fp in sort_fingerprints(fingerprints, order_by) if explainable_command(fp)][:options['top']]
+    cache = load_explain_cache(options['cache'])
+    max_age = timedelta(hours=options['max_age'])
+
+    results = {}
+    pending = []
+    for fingerprint in top:
+        # Plans are cached by planCacheKey/queryHash when known, otherwise by the shape hash
+        cache_key = f"{fingerprint['ns']}|{fingerprint.get('plan_key') or fingerprint['id']}"
+        cached = cache.get(cache_key)
+        if cached and utc_now() - text_to_ts(cached['explained_at']) < max_age:
+            results[fingerprint['id']] = cached
         else:
-            start_time_str = 'N/A'
-
-        exec_time = entry.get('millis', 0)
-        docs_examined = entry.get('docsExamined', 0)
-        docs_returned = entry.get('nreturned', 0)
-        response_length = entry.get('responseLength', 0)
-        ns = entry.get('ns', 'N/A')
-        query = entry.get('query', entry.get('command', 'N/A'))
-
-        print(f"# Query {i+1}:  0.00 QPS, ID {query_id}")
-        print(f"# Ratio    1.00  (docs scanned/returned)")
-        print(f"# Time range: {start_time_str} to {start_time_str}")
-        print("# Attribute            pct     total        min         max        avg         95%        stddev      median")
-        print("# ==================   ===   ========    ========    ========    ========    ========     =======    ========")
-        print(f"# Exec Time ms         0         0           0           {exec_time:.2f}           {avg_exec_time:.2f}           0           {stddev_exec_time:.2f}           0")
-        print(f"# Docs Scanned         0    {total_docs_scanned:.2f}        0.00       {docs_examined:.2f}        {avg_docs_scanned:.2f}       0           {stddev_docs_scanned:.2f}        0.00")
-        print(f"# Docs Returned        0    {total_docs_returned:.2f}        0.00       {docs_returned:.2f}        {avg_docs_returned:.2f}       0           {stddev_docs_returned:.2f}        0.00")
-        print(f"# Bytes recv           0    {total_bytes_recv:.2f}        0.00       {response_length:.2f}        {avg_bytes_recv:.2f}       0           {stddev_bytes_recv:.2f}        0.00")
-        print("# String:")
-        print(f"# Namespaces          {ns}")
-        print(f"# Fingerprint         {query}\n")
+            pending.append((cache_key, fingerprint))
+    logging.info(f"Explaining {len(pending)} fingerprint(s), {len(results)} served from cache")
+
+    with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+        futures = {pool.submit(explain_fingerprint, client, fingerprint, options['ratio']): (cache_key, fingerprint) for cache_key, fingerprint in pending}
+        for future in as_completed(futures):
+            cache_key, fingerprint = futures[future]
+            try:
+                results[fingerprint['id']] = cache[cache_key] = future.result()
+            except Exception as e:
+                logging.warning(f"Failed to explain {fingerprint['id']} on {fingerprint['ns']}: {e}")
+
+    save_explain_cache(options['cache'], cache)
+    print_explain_report(top, results)
+
+def print_explain_report(fingerprints, results):
+    print("# Explain ######################################################################################")
+    for fingerprint in fingerprints:
+        result = results.get(fingerprint['id'])
+        if not result:
+            continue
+        findings = ', '.join(result['findings']) if result['findings'] else 'none'
+        print(f"# {fingerprint['id']}  {fingerprint['ns']} {fingerprint['op']}")
+        print(f"#   Plan       {result['plan']}")
+        print(f"#   Examined   keys {result['keysExamined']}, docs {result['docsExamined']}, returned {result['nreturned']}")
+        print(f"#   Issues     {findings}")
+    print()
+
+def open_digest_store(path):
+    store = sqlite3.connect(path)
+    store.executescript("""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            source TEXT NOT NULL,
+            first_seen TEXT,
+            last_seen TEXT
+        );
+        CREATE TABLE IF NOT EXISTS digests (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id),
+            id TEXT NOT NULL,
+            ns TEXT NOT NULL,
+            op TEXT NOT NULL,
+            shape TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_seen TEXT,
+            last_seen TEXT,
+            hosts TEXT,
+            metrics TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS digests_run_id ON digests (run_id);
+        CREATE TABLE IF NOT EXISTS watermarks (
+            node TEXT NOT NULL,
+            db TEXT NOT NULL,
+            last_ts TEXT NOT NULL,
+            PRIMARY KEY (node, db)
+        );
+        CREATE TABLE IF NOT EXISTS watermark_entries (
+            node TEXT NOT NULL,
+            db TEXT NOT NULL,
+            entry TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS watermark_entries_node_db ON watermark_entries (node, db);
+    """)
+    return store
+
+def ts_to_text(ts):
+    return ts.isoformat() if isinstance(ts, datetime) else None
+
+def text_to_ts(text):
+    return datetime.fromisoformat(text) if text else None
+
+def load_watermark(store, node, db_name):
+    row = store.execute("SELECT last_ts FROM watermarks WHERE node = ? AND db = ?", (node, db_name)).fetchone()
+    if not row:
+        return None
+    entries = store.execute("SELECT entry FROM watermark_entries WHERE node = ? AND db = ?", (node, db_name))
+    return {'ts': text_to_ts(row[0]), 'entries': [json.loads(entry) for entry, in entries]}
+
+def save_watermark(store, node, db_name, watermark):
+    if watermark['ts'] is None:
+        return
+    with store:
+        current = load_watermark(store, node, db_name)
+        if current and current['ts'] > watermark['ts']:
+            return
+        store.execute("""
+            INSERT INTO watermarks (node, db, last_ts) VALUES (?, ?, ?)
+            ON CONFLICT (node, db) DO UPDATE SET last_ts = excluded.last_ts
+        """, (node, db_name, ts_to_text(watermark['ts'])))
+        store.execute("DELETE FROM watermark_entries WHERE node = ? AND db = ?", (node, db_name))
+        store.executemany("INSERT INTO watermark_entries (node, db, entry) VALUES (?, ?, ?)",
+                          ((node, db_name, json.dumps(values)) for values in watermark['entries']))
+
+def watermark_query(query, watermark):
+    # $gte keeps entries logged later in the watermark millisecond, the ones already stored are excluded by value
+    query = dict(query, ts={'$gte': watermark['ts']})
+    if watermark['entries']:
+        query['$nor'] = [dict(zip(WATERMARK_FIELDS, values), ts=watermark['ts']) for values in watermark['entries']]
+    return query
+
+def new_watermark(watermark):
+    if not watermark:
+        return {'ts': None, 'entries': []}
+    return {'ts': watermark['ts'], 'entries': list(watermark['entries'])}
+
+def advance_watermark(watermark, entry):
+    # Remembers the newest ts and every entry logged in that millisecond
+    ts = entry.get('ts')
+    if not isinstance(ts, datetime):
+        return
+    values = [entry.get(field) for field in WATERMARK_FIELDS]
+    if watermark['ts'] is None or ts > watermark['ts']:
+        watermark['ts'] = ts
+        watermark['entries'] = [values]
+    elif ts == watermark['ts']:
+        watermark['entries'].append(values)
+
+def track_watermark(entries, watermark):
+    for entry in entries:
+        advance_watermark(watermark, entry)
+        yield entry
+
+def serialize_metrics(metrics):
+    state = {}
+    for field, metric in metrics.items():
+        state[field] = dict(metric)
+        if metric.get('sketch') is not None:
+            state[field]['sketch'] = {'zero': metric['sketch']['zero'], 'buckets': list(metric['sketch']['buckets'].items())}
+    return json.dumps(state, separators=(',', ':'))
+
+def deserialize_metrics(text):
+    metrics = json.loads(text)
+    for metric in metrics.values():
+        if metric.get('sketch') is not None:
+            metric['sketch']['buckets'] = {index: count for index, count in metric['sketch']['buckets']}
+    return metrics
+
+def save_run(store, source, fingerprints):
+    first_seen = [fp['first_seen'] for fp in fingerprints.values() if fp['first_seen']]
+    last_seen = [fp['last_seen'] for fp in fingerprints.values() if fp['last_seen']]
+    with store:
+        cursor = store.execute(
+            "INSERT INTO runs (created_at, source, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+            (ts_to_text(utc_now()), source, ts_to_text(min(first_seen)) if first_seen else None, ts_to_text(max(last_seen)) if last_seen else None))
+        run_id = cursor.lastrowid
+        store.executemany(
+            "INSERT INTO digests (run_id, id, ns, op, shape, count, first_seen, last_seen, hosts, metrics) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((run_id, fp['id'], fp['ns'], fp['op'], fp['shape'], fp['count'], ts_to_text(fp['first_seen']), ts_to_text(fp['last_seen']),
+              json.dumps(sorted(fp['hosts'])) if fp.get('hosts') else None, serialize_metrics(fp['metrics']))
+             for fp in fingerprints.values()))
+    return run_id
+
+def select_run_ids(store, selector):
+    # A selector is either a run id or an ISO time range "start/end" matched against the collected entries
+    if '/' not in selector:
+        return [int(selector)]
+    start, end = (parse_utc_ts(text) for text in selector.split('/', 1))
+    # Compared as datetimes, the stored text and the selector can differ in precision and offset notation
+    rows = store.execute("SELECT run_id, first_seen, last_seen FROM runs WHERE first_seen IS NOT NULL AND last_seen IS NOT NULL ORDER BY run_id")
+    return [run_id for run_id, first_seen, last_seen in rows if text_to_ts(last_seen) >= start and text_to_ts(first_seen) < end]
+
+def load_fingerprints(store, selector):
+    run_ids = select_run_ids(store, selector)
+    fingerprints = {}
+    if not run_ids:
+        return fingerprints
+    placeholders = ','.join('?' * len(run_ids))
+    rows = store.execute(f"SELECT id, ns, op, shape, count, first_seen, last_seen, hosts, metrics FROM digests WHERE run_id IN ({placeholders})", run_ids)
+    for fp_id, ns, op, shape, count, first_seen, last_seen, hosts, metrics in rows:
+        fingerprint = {
+            'id': fp_id,
+            'ns': ns,
+            'op': op,
+            'shape': shape,
+            'count': count,
+            'first_seen': text_to_ts(first_seen),
+            'last_seen': text_to_ts(last_seen),
+            'metrics': deserialize_metrics(metrics),
+        }
+        if hosts:
+            fingerprint['hosts'] = set(json.loads(hosts))
+        merge_fingerprints(fingerprints, {(ns, op, shape): fingerprint})
+    return fingerprints
+
+def print_runs(store):
+    print(f"{'Run':<6} {'Created':<26} {'First entry':<26} {'Last entry':<26} {'Fingerprints':>12}  Source")
+    rows = store.execute("""
+        SELECT runs.run_id, created_at, runs.first_seen, runs.last_seen, COUNT(digests.id), source
+        FROM runs LEFT JOIN digests ON digests.run_id = runs.run_id
+        GROUP BY runs.run_id ORDER BY runs.run_id
+    """)
+    for run_id, created_at, first_seen, last_seen, fingerprints, source in rows:
+        print(f"{run_id:<6} {created_at:<26} {first_seen or 'N/A':<26} {last_seen or 'N/A':<26} {fingerprints:>12}  {source}")
+
+def diff_fingerprints(before, after, threshold):
+    regressions = []
+    for key, fingerprint in after.items():
+        new_p95 = metric_summary(fingerprint['metrics']['millis'], fingerprint['count'])['95%']
+        new_ratio = fingerprint_ratio(fingerprint)
+        old = before.get(key)
+        if old is None:
+            regressions.append((fingerprint, 'new', None, new_p95, None, new_ratio))
+            continue
+        old_p95 = metric_summary(old['metrics']['millis'], old['count'])['95%']
+        old_ratio = fingerprint_ratio(old)
+        reasons = []
+        if new_p95 > old_p95 * (1 + threshold) and new_p95 > old_p95:
+            reasons.append('p95')
+        if new_ratio > old_ratio * (1 + threshold) and new_ratio > old_ratio:
+            reasons.append('ratio')
+        if reasons:
+            regressions.append((fingerprint, '+'.join(reasons), old_p95, new_p95, old_ratio, new_ratio))
+    regressions.sort(key=lambda row: row[3] - (row[2] or 0), reverse=True)
+    return regressions
+
+def run_diff(store, before_selector, after_selector, threshold, limit):
+    before = load_fingerprints(store, before_selector)
+    after = load_fingerprints(store, after_selector)
+    logging.info(f"Comparing {len(before)} fingerprint(s) in {before_selector} with {len(after)} in {after_selector}")
+
+    regressions = diff_fingerprints(before, after, threshold)
+    if limit:
+        regressions = regressions[:limit]
+    if not regressions:
+        print(f"No regressions above {threshold:.0%} found.")
+        return
+
+    print(f"# Regressions above {threshold:.0%} from {before_selector} to {after_selector}")
+    print(f"# {'ID':<16}   {'Reason':<9}   {'95% ms before':>13}   {'95% ms after':>12}   {'Ratio before':>12}   {'Ratio after':>11}   Namespace / Operation")
+    for fingerprint, reason, old_p95, new_p95, old_ratio, new_ratio in regressions:
+        old_p95_text = f"{old_p95:.2f}" if old_p95 is not None else 'N/A'
+        old_ratio_text = f"{old_ratio:.2f}" if old_ratio is not None else 'N/A'
+        print(f"# {fingerprint['id']:<16}   {reason:<9}   {old_p95_text:>13}   {new_p95:>12.2f}   {old_ratio_text:>12}   {new_ratio:>11.2f}   {fingerprint['ns']} {fingerprint['op']}")
+    for fingerprint, *_ in regressions:
+        print(f"# {fingerprint['id']}  {fingerprint['shape']}")
 
 def main():
     parser = argparse.ArgumentParser(description="MongoDB Profiling Query Script")
     parser.add_argument('-u', '--username', help="Specifies the user name for connecting to a server with authentication enabled.")
     parser.add_argument('-p', '--password', help="Specifies the password to use when connecting to a server with authentication enabled.")
     parser.add_argument('-a', '--auth_db', help="Specifies the database used to establish credentials and privileges with a MongoDB server.", default='admin')
-    parser.add_argument('-d', '--database', required=True, help="Specifies which database to profile")
+    parser.add_argument('-d', '--database', help="Specifies which database to profile. Required unless --log-file or --cluster is used. With --cluster it accepts a comma separated list, default all databases. With --log-file it filters entries by namespace")
     parser.add_argument('--mongo_host', help="Specifies the MongoDB host", default='localhost:27017')
     parser.add_argument('-l', '--log_level', help="Specifies the log level: panic, fatal, error, warn, info, debug", default=None)
     parser.add_argument('-n', '--limit', type=int, help="Limits the number of queries to show. Default : everything", default=0)
-    parser.add_argument('-o', '--order_by', help="Specifies the sorting order using fields: count, ratio, query-time, docs-scanned, docs-returned", default='')
+    parser.add_argument('-o', '--order_by', help="Specifies the sorting order using fields: count, ratio, query-time, docs-scanned, docs-returned. Prefix with '-' for descending. Default: -query-time", default='')
+    parser.add_argument('--server-side', action='store_true', help="Group and summarize profile entries on the server with an aggregation pipeline, only summary rows are transferred")
+    parser.add_argument('--columnar', action='store_true', help="Fetch only the metric fields into typed NumPy arrays and compute all statistics vectorized, grouping by namespace, operation and queryHash")
+    parser.add_argument('--batch-size', type=int, help="Number of profile documents fetched per cursor batch. Default: 10000", default=10000)
+    parser.add_argument('--log-file', nargs='+', help="Analyze \"Slow query\" entries from one or more mongod 4.4+ JSON log files (plain or .gz) instead of system.profile")
+    parser.add_argument('--workers', type=int, help="Number of worker processes used to parse log files. Default: number of CPUs", default=os.cpu_count() or 1)
+
+    parser.add_argument('--follow', action='store_true', help="Tail system.profile with a tailable cursor and print the top offenders over rolling 1m/5m/15m windows every refresh interval")
+    parser.add_argument('--since', type=parse_utc_ts, help="Timestamp (ISO format, UTC unless it has an offset) to start following from. Default: now", default=None)
+    parser.add_argument('--refresh', type=float, help="Seconds between --follow reports. Default: 10", default=10)
+    parser.add_argument('--max-fingerprints', type=int, help="Maximum number of fingerprints tracked by --follow, least recently seen are dropped first. Default: 10000", default=10000)
+
+    parser.add_argument('--cluster', action='store_true', help="Discover every shard and replica set member from --mongo_host and read their profile collections in parallel into one report")
+    parser.add_argument('--cluster-workers', type=int, help="Maximum number of profile collections read at the same time with --cluster. Default: 16", default=16)
+
+    parser.add_argument('--sketch-error', type=float, help="Relative error of the percentile sketches used once a fingerprint has more than --exact-limit values. Default: 0.01", default=0.01)
+    parser.add_argument('--exact-limit', type=int, help="Number of values per fingerprint and metric kept for exact percentiles before switching to a sketch. Default: 1000", default=1000)
+
+    parser.add_argument('--store', help="SQLite digest store. Each run saves its fingerprints there and only reads profile entries newer than the last run per node and database")
+    parser.add_argument('--list-runs', action='store_true', help="List the runs saved in --store")
+    parser.add_argument('--diff', nargs=2, metavar=('BEFORE', 'AFTER'), help="Compare two runs from --store, each given as a run id or an ISO time range START/END, and flag fingerprints whose 95%% exec time or scanned/returned ratio regressed")
+    parser.add_argument('--regression-threshold', type=float, help="Relative increase reported as a regression by --diff. Default: 0.2", default=0.2)
+
+    parser.add_argument('--explain', type=int, metavar='N', help="Run explain with executionStats on the top N fingerprints and flag COLLSCAN, in-memory SORT and high keysExamined/nreturned ratios", default=0)
+    parser.add_argument('--explain-workers', type=int, help="Number of explain commands run at the same time. Default: 8", default=8)
+    parser.add_argument('--explain-cache', help="JSON file caching explain results by planCacheKey/queryHash between runs")
+    parser.add_argument('--explain-max-age', type=float, help="Hours a cached explain result is reused. Default: 24", default=24)
+    parser.add_argument('--explain-ratio', type=float, help="keysExamined/nreturned ratio flagged by --explain. Default: 10", default=10)
 
     args = parser.parse_args()
 
+    if (args.list_runs or args.diff) and not args.store:
+        parser.error("--list-runs and --diff require --store")
+    if args.store and (args.server_side or args.columnar or args.log_file or args.follow):
+        parser.error("--store can't be combined with --server-side, --columnar, --log-file or --follow")
+
+    if not args.database and not args.log_file and not args.cluster and not args.store:
+        parser.error("the following arguments are required: -d/--database")
+
     setup_logging(args.log_level or 'debug')  # Default to 'debug' if log_level is not provided
+    configure_sketch(args.sketch_error, args.exact_limit)
+
+    store = open_digest_store(args.store) if args.store else None
+    if args.list_runs:
+        print_runs(store)
+        return
+    if args.diff:
+        run_diff(store, args.diff[0], args.diff[1], args.regression_threshold, args.limit)
+        return
+    if store and not args.database and not args.cluster:
+        parser.error("the following arguments are required: -d/--database")
+
+    explain = None
+    if args.explain:
+        explain = {'top': args.explain, 'workers': args.explain_workers, 'cache': args.explain_cache, 'max_age': args.explain_max_age, 'ratio': args.explain_ratio}
+
+    if args.follow:
+        client = get_mongo_client(args.username, args.password, args.auth_db, args.mongo_host)
+        try:
+            follow_profile(client, args.database, args.log_level, args.since, args.refresh, args.limit or 10, args.max_fingerprints)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.cluster:
+        db_names = args.database.split(',') if args.database else []
+        run_cluster_query(db_names, args.username, args.password, args.auth_db, args.mongo_host, args.log_level, args.limit, args.order_by, args.batch_size, args.cluster_workers, store, explain)
+        return
+
+    if args.log_file:
+        run_log_analysis(args.log_file, args.database, args.log_level, args.limit, args.order_by, args.workers)
+        return
 
-    run_mongo_query(args.database, args.username, args.password, args.auth_db, args.mongo_host, args.log_level, args.limit, args.order_by)
+    run_mongo_query(args.database, args.username, args.password, args.auth_db, args.mongo_host, args.log_level, args.limit, args.order_by, args.server_side, args.columnar, args.batch_size, store, explain)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,8 @@
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
 import argparse
 import time
+from heartbeat_monitor import new_sdam_state, run_monitor, run_sdam_monitor, sdam_client
 
 def get_replica_set_status(host, port, username, password):
     if username and password:
@@ -40,12 +41,30 @@ def analyze_heartbeat_info(heartbeat_info):
     
     return issues
 
+def poll_replica_set(client):
+    try:
+        status = client.admin.command('replSetGetStatus', read_preference=ReadPreference.PRIMARY_PREFERRED)
+        return [(status.get('set'), status, None)]
+    except Exception as e:
+        return [(None, None, e)]
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Check heartbeat status in a MongoDB replicated cluster.')
     parser.add_argument('--host', type=str, default='localhost', help='MongoDB host (default: localhost)')
     parser.add_argument('--port', type=str, default='27017', help='MongoDB port (default: 27017)')
     parser.add_argument('--username', type=str, help='MongoDB username')
     parser.add_argument('--password', type=str, help='MongoDB password')
+    parser.add_argument('--sdam', action='store_true', help='Report from the driver heartbeat and topology events instead of replSetGetStatus, with RTT histograms and live election/failover events')
+    parser.add_argument('--heartbeat-frequency', type=float, default=5, help='Seconds between driver heartbeats with --sdam (default: 5)')
+    parser.add_argument('--report-interval', type=float, default=30, help='Seconds between reports with --sdam (default: 30)')
+    parser.add_argument('--duration', type=float, default=0, help='Stop --sdam after this many seconds (default: 0, run until interrupted)')
+    parser.add_argument('--monitor', action='store_true', help='Keep polling every --interval seconds and report rolling lag, ping and heartbeat statistics per member')
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between polls with --monitor (default: 10)')
+    parser.add_argument('--polls', type=int, default=0, help='Stop after this many polls with --monitor (default: 0, run until interrupted)')
+    parser.add_argument('--history', type=int, default=360, help='Polls kept per member for the rolling statistics (default: 360)')
+    parser.add_argument('--lag-threshold', type=float, default=10, help='Seconds behind the primary a member may lag with --monitor (default: 10)')
+    parser.add_argument('--sustained-polls', type=int, default=3, help='Consecutive polls above --lag-threshold before lag is reported (default: 3)')
+    parser.add_argument('--flush-file', type=str, help='Append every sample to this binary file with --monitor')
 
     args = parser.parse_args()
     
@@ -53,7 +72,21 @@ if __name__ == "__main__":
         uri = f"mongodb://{args.username}:{args.password}@{args.host}:{args.port}/admin"
     else:
         uri = f"mongodb://{args.host}:{args.port}/admin"
-    
+
+    if args.sdam:
+        state = new_sdam_state()
+        client = sdam_client(uri, state, args)
+        run_sdam_monitor(state, args, analyze_heartbeat_info)
+        client.close()
+        raise SystemExit
+
+    if args.monitor:
+        # One client for the whole run instead of a new connection per poll
+        client = MongoClient(uri)
+        run_monitor(lambda: poll_replica_set(client), args)
+        client.close()
+        raise SystemExit
+
     repl_status = get_replica_set_status(args.host, args.port, args.username, args.password)
     
     if repl_status:
@@ -1,50 +1,103 @@
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
 import argparse
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from heartbeat_monitor import new_sdam_state, run_monitor, run_sdam_monitor, sdam_client
 
-def get_replica_set_status(host, port, username, password):
-    if username and password:
-        uri = f"mongodb://{username}:{password}@{host}:{port}/admin"
-    else:
-        uri = f"mongodb://{host}:{port}/admin"
-        
-    client = MongoClient(uri)
-    
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+def get_client(hosts, set_name, username, password, timeout):
+    # One client per replica set, reused by every probe instead of being rebuilt and torn down
+    key = (hosts, set_name)
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(key)
+        if client is None:
+            timeout_ms = int(timeout * 1000)
+            client = CLIENTS[key] = MongoClient(hosts.split(','), replicaSet=set_name, username=username, password=password, authSource='admin',
+                                                serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+        return client
+
+def close_clients():
+    with CLIENTS_LOCK:
+        for client in CLIENTS.values():
+            client.close()
+        CLIENTS.clear()
+
+def probe_replica_set(name, conn_str, username, password, timeout):
+    set_name, _, hosts = conn_str.rpartition('/')
+    client = get_client(hosts, set_name or None, username, password, timeout)
+    # Any member can answer, so a replica set without a primary is still reported
+    return client.admin.command('replSetGetStatus', read_preference=ReadPreference.PRIMARY_PREFERRED)
+
+def get_probe_targets(client):
+    targets = [(shard['_id'], shard['host']) for shard in client.admin.command('listShards')['shards']]
+    config_conn_str = client.admin.command('serverStatus').get('sharding', {}).get('configsvrConnectionString')
+    if config_conn_str:
+        targets.append(('config', config_conn_str))
+    return targets
+
+def probe_replica_sets(targets, username, password, timeout, workers):
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets))))
+    started = {}
+
+    def run(name, conn_str):
+        started[name] = time.monotonic()
+        return probe_replica_set(name, conn_str, username, password, timeout)
+
+    futures = {}
+    for name, conn_str in targets:
+        futures[pool.submit(run, name, conn_str)] = (name, conn_str)
+    # Each probe's deadline starts when a worker picks it up, probes queued behind unreachable shards are not charged for the wait
+    pending = set(futures)
+    expired = set()
+    while pending:
+        _, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        now = time.monotonic()
+        late = {future for future in pending if now - started.get(futures[future][0], now) > timeout + 1}
+        expired |= late
+        pending -= late
+    pool.shutdown(wait=False)
+
+    probes = []
+    for future, (name, conn_str) in futures.items():
+        if future in expired:
+            probes.append((name, conn_str, None, f"no answer within {timeout} seconds"))
+        elif future.exception():
+            probes.append((name, conn_str, None, str(future.exception())))
+        else:
+            probes.append((name, conn_str, future.result(), None))
+    return probes
+
+def check_shard_heartbeat(shard_uri, username, password, timeout=5, workers=16):
+    client = MongoClient(shard_uri, serverSelectionTimeoutMS=int(timeout * 1000))
     try:
-        status = client.admin.command('replSetGetStatus')
-        return status
-    except Exception as e:
-        print(f"Error getting replSetGetStatus: {e}")
-        return None
+        targets = get_probe_targets(client)
     finally:
         client.close()
 
-def check_shard_heartbeat(shard_uri, username, password):
-    client = MongoClient(shard_uri)
-    shard_status = client.admin.command('listShards')
-    
     heartbeat_info = {}
-    
-    for shard in shard_status['shards']:
-        shard_conn_str = shard['host']
-        primary_host = shard_conn_str.split('/')[1].split(',')[0]  # Get primary host
-        print(f"Checking heartbeat for shard: {shard['_id']} at {primary_host}")
-        
-        host, port = primary_host.split(':')
-        repl_status = get_replica_set_status(host, port, username, password)
-        
-        if repl_status:
-            for member in repl_status['members']:
-                heartbeat_info[member['name']] = {
-                    'state': member['stateStr'],
-                    'health': member['health'],
-                    'uptime': member['uptime'],
-                    'lastHeartbeat': member.get('lastHeartbeat', 'N/A'),
-                    'lastHeartbeatRecv': member.get('lastHeartbeatRecv', 'N/A'),
-                    'lastHeartbeatMessage': member.get('lastHeartbeatMessage', 'N/A')
-                }
-    
+
+    for name, conn_str in targets:
+        print(f"Checking heartbeat for shard: {name} at {conn_str.rpartition('/')[2]}")
+
+    for name, conn_str, status, error in probe_replica_sets(targets, username, password, timeout, workers):
+        if error:
+            heartbeat_info[f"{name} ({conn_str})"] = {'shard': name, 'state': 'UNREACHABLE', 'health': 0, 'error': error}
+            continue
+        for member in status['members']:
+            heartbeat_info[member['name']] = {
+                'shard': name,
+                'state': member['stateStr'],
+                'health': member['health'],
+                'uptime': member['uptime'],
+                'lastHeartbeat': member.get('lastHeartbeat', 'N/A'),
+                'lastHeartbeatRecv': member.get('lastHeartbeatRecv', 'N/A'),
+                'lastHeartbeatMessage': member.get('lastHeartbeatMessage', 'N/A')
+            }
+
     return heartbeat_info
 
 def analyze_heartbeat_info(heartbeat_info):
@@ -52,6 +105,10 @@ def analyze_heartbeat_info(heartbeat_info):
     issues = []
     
     for member, info in heartbeat_info.items():
+        if 'error' in info:
+            issues.append(f"Replica set {info['shard']} could not be probed: {info['error']}")
+            continue
+
         last_heartbeat = info.get('lastHeartbeat', 'N/A')
         last_heartbeat_recv = info.get('lastHeartbeatRecv', 'N/A')
         last_heartbeat_message = info.get('lastHeartbeatMessage', 'N/A')
@@ -67,12 +124,32 @@ def analyze_heartbeat_info(heartbeat_info):
     
     return issues
 
+def poll_cluster(client, args):
+    try:
+        targets = get_probe_targets(client)
+    except Exception as e:
+        return [('mongos', None, e)]
+    return [(name, status, error) for name, _, status, error in probe_replica_sets(targets, args.username, args.password, args.timeout, args.workers)]
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Check heartbeat status in a MongoDB sharded cluster.')
     parser.add_argument('--host', type=str, default='localhost', help='MongoDB host (default: localhost)')
     parser.add_argument('--port', type=str, default='27017', help='MongoDB port (default: 27017)')
     parser.add_argument('--username', type=str, help='MongoDB username')
     parser.add_argument('--password', type=str, help='MongoDB password')
+    parser.add_argument('--timeout', type=float, default=5, help='Seconds each shard probe may take before it is reported unreachable (default: 5)')
+    parser.add_argument('--workers', type=int, default=16, help='Number of shards probed at the same time (default: 16)')
+    parser.add_argument('--sdam', action='store_true', help='Report from the driver heartbeat and topology events instead of replSetGetStatus, with RTT histograms and live election/failover events')
+    parser.add_argument('--heartbeat-frequency', type=float, default=5, help='Seconds between driver heartbeats with --sdam (default: 5)')
+    parser.add_argument('--report-interval', type=float, default=30, help='Seconds between reports with --sdam (default: 30)')
+    parser.add_argument('--duration', type=float, default=0, help='Stop --sdam after this many seconds (default: 0, run until interrupted)')
+    parser.add_argument('--monitor', action='store_true', help='Keep polling every --interval seconds and report rolling lag, ping and heartbeat statistics per member')
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between polls with --monitor (default: 10)')
+    parser.add_argument('--polls', type=int, default=0, help='Stop after this many polls with --monitor (default: 0, run until interrupted)')
+    parser.add_argument('--history', type=int, default=360, help='Polls kept per member for the rolling statistics (default: 360)')
+    parser.add_argument('--lag-threshold', type=float, default=10, help='Seconds behind the primary a member may lag with --monitor (default: 10)')
+    parser.add_argument('--sustained-polls', type=int, default=3, help='Consecutive polls above --lag-threshold before lag is reported (default: 3)')
+    parser.add_argument('--flush-file', type=str, help='Append every sample to this binary file with --monitor')
 
     args = parser.parse_args()
     
@@ -80,8 +157,34 @@ if __name__ == "__main__":
         shard_uri = f"mongodb://{args.username}:{args.password}@{args.host}:{args.port}/admin"
     else:
         shard_uri = f"mongodb://{args.host}:{args.port}/admin"
-    
-    heartbeat_info = check_shard_heartbeat(shard_uri, args.username, args.password)
+
+    if args.sdam:
+        # One monitored client per shard and for the config servers, the mongos client is only used for discovery
+        client = MongoClient(shard_uri, serverSelectionTimeoutMS=int(args.timeout * 1000))
+        targets = get_probe_targets(client)
+        client.close()
+        state = new_sdam_state()
+        sdam_clients = []
+        for name, conn_str in targets:
+            set_name, _, hosts = conn_str.rpartition('/')
+            print(f"Monitoring shard: {name} at {hosts}")
+            sdam_clients.append(sdam_client(hosts.split(','), state, args, replicaSet=set_name or None,
+                                            username=args.username, password=args.password, authSource='admin'))
+        run_sdam_monitor(state, args, analyze_heartbeat_info)
+        for monitored_client in sdam_clients:
+            monitored_client.close()
+        raise SystemExit
+
+    if args.monitor:
+        # The mongos client and the per replica set clients are reused by every poll
+        client = MongoClient(shard_uri, serverSelectionTimeoutMS=int(args.timeout * 1000))
+        run_monitor(lambda: poll_cluster(client, args), args)
+        client.close()
+        close_clients()
+        raise SystemExit
+
+    heartbeat_info = check_shard_heartbeat(shard_uri, args.username, args.password, args.timeout, args.workers)
+    close_clients()
     
     if heartbeat_info:
         print("Replication heartbeat information:")
@@ -0,0 +1,302 @@
+# Rolling --monitor mode and --sdam driver event backend shared by the replicated and sharded heartbeat profilers
+
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timezone
+import pymongo
+from pymongo import MongoClient, monitoring
+
+# Flush file records: a member name is written once, then one fixed size sample per member and poll
+NAME_RECORD = struct.Struct('<BHH')
+SAMPLE_RECORD = struct.Struct('<BdHfffb')
+
+def new_member_series(history):
+    # Fixed size ring buffers, memory does not grow with the time the monitor runs
+    return {
+        'ts': deque(maxlen=history),
+        'lag': deque(maxlen=history),
+        'ping': deque(maxlen=history),
+        'heartbeat_age': deque(maxlen=history),
+        'transitions': deque(maxlen=history),
+        'state': None,
+        'lagging_polls': 0
+    }
+
+def record_status(monitor, set_name, status, history):
+    now = status['date']
+    primary = next((member for member in status['members'] if member.get('stateStr') == 'PRIMARY'), None)
+    samples = []
+    for member in status['members']:
+        name = member['name']
+        series = monitor.setdefault(name, new_member_series(history))
+        series['set'] = set_name
+        lag = None
+        if primary and member.get('optimeDate') and primary.get('optimeDate'):
+            lag = max((primary['optimeDate'] - member['optimeDate']).total_seconds(), 0)
+        # Heartbeat age is measured against the server's own clock, not the local one
+        recv = member.get('lastHeartbeatRecv')
+        heartbeat_age = (now - recv).total_seconds() if recv else None
+        ping = member.get('pingMs')
+
+        if series['state'] is not None and series['state'] != member['stateStr']:
+            series['transitions'].append((now, series['state'], member['stateStr']))
+        series['state'] = member['stateStr']
+        series['ts'].append(now)
+        series['lag'].append(lag)
+        series['ping'].append(ping)
+        series['heartbeat_age'].append(heartbeat_age)
+        samples.append((name, now, lag, ping, heartbeat_age, member.get('state', -1)))
+    return samples
+
+def percentile(values, fraction):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def monitor_issues(monitor, sampled, lag_threshold, sustained_polls, since):
+    issues = []
+    for name, series in monitor.items():
+        # Members of a replica set that was not probed this poll only have stale samples
+        if name not in sampled:
+            continue
+        lag = series['lag'][-1] if series['lag'] else None
+        # Only lag that stays above the threshold for several polls in a row is flagged, single spikes are not
+        series['lagging_polls'] = series['lagging_polls'] + 1 if lag is not None and lag > lag_threshold else 0
+        if series['lagging_polls'] >= sustained_polls:
+            issues.append(f"Member {name} has lagged more than {lag_threshold}s behind the primary for {series['lagging_polls']} polls (now {lag:.1f}s).")
+        for ts, before, after in series['transitions']:
+            if ts >= since:
+                issues.append(f"Member {name} changed state from {before} to {after} at {ts}.")
+    return issues
+
+def format_value(value, unit):
+    return 'n/a' if value is None else f"{value:.1f}{unit}"
+
+def print_monitor_report(monitor):
+    print(f"\n{'MEMBER':<30} {'SET':<14} {'STATE':<10} {'LAG':>8} {'LAG P50':>8} {'LAG P99':>8} {'PING':>8} {'PING P99':>8} {'HB AGE':>8} {'CHANGES':>7}")
+    for name, series in sorted(monitor.items(), key=lambda item: (item[1].get('set') or '', item[0])):
+        print(f"{name:<30} {series.get('set') or '':<14} {series['state']:<10} {format_value(series['lag'][-1], 's'):>8} "
+              f"{format_value(percentile(series['lag'], 0.5), 's'):>8} {format_value(percentile(series['lag'], 0.99), 's'):>8} "
+              f"{format_value(series['ping'][-1], 'ms'):>8} {format_value(percentile(series['ping'], 0.99), 'ms'):>8} "
+              f"{format_value(series['heartbeat_age'][-1], 's'):>8} {len(series['transitions']):>7}")
+
+def flush_samples(flush, member_ids, samples):
+    for name, ts, lag, ping, heartbeat_age, state in samples:
+        member_id = member_ids.get(name)
+        if member_id is None:
+            member_id = member_ids[name] = len(member_ids)
+            encoded = name.encode()
+            flush.write(NAME_RECORD.pack(0, member_id, len(encoded)) + encoded)
+        nan = float('nan')
+        flush.write(SAMPLE_RECORD.pack(1, ts.replace(tzinfo=timezone.utc).timestamp(), member_id,
+                                       nan if lag is None else lag, nan if ping is None else ping,
+                                       nan if heartbeat_age is None else heartbeat_age, state))
+    flush.flush()
+
+def run_monitor(poll, args):
+    monitor = {}
+    member_ids = {}
+    flush = open(args.flush_file, 'ab') if args.flush_file else None
+    polls = 0
+    try:
+        while not args.polls or polls < args.polls:
+            started = time.time()
+            polls += 1
+            since = None
+            samples = []
+            for set_name, status, error in poll():
+                if status is None:
+                    print(f"Replica set {set_name} could not be probed: {error}")
+                    continue
+                since = min(since, status['date']) if since else status['date']
+                samples.extend(record_status(monitor, set_name, status, args.history))
+            if flush:
+                flush_samples(flush, member_ids, samples)
+
+            print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] poll {polls}")
+            print_monitor_report(monitor)
+            issues = monitor_issues(monitor, {sample[0] for sample in samples}, args.lag_threshold, args.sustained_polls, since) if since else []
+            for issue in issues:
+                print(f"- {issue}")
+            if args.polls and polls >= args.polls:
+                break
+            time.sleep(max(0, args.interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if flush:
+            flush.close()
+
+# Upper bounds in milliseconds of the RTT histogram buckets, the last one catches everything slower
+RTT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+MEMBER_STATES = {'RSPrimary': 'PRIMARY', 'RSSecondary': 'SECONDARY', 'RSArbiter': 'ARBITER', 'RSOther': 'OTHER', 'RSGhost': 'GHOST', 'Unknown': 'UNKNOWN', 'Mongos': 'MONGOS'}
+
+def new_sdam_state():
+    # Only the last events are kept for the report, every event is printed when it happens
+    return {'lock': threading.Lock(), 'members': {}, 'events': deque(maxlen=10)}
+
+def sdam_member(state, address):
+    name = f"{address[0]}:{address[1]}"
+    return state['members'].setdefault(name, {
+        'rtt': [0] * len(RTT_BUCKETS), 'last_rtt': None, 'failures': 0,
+        'last_success': None, 'last_failure': None, 'state': 'UNKNOWN', 'set': None
+    })
+
+def sdam_event(state, message):
+    # Printed as soon as the driver sees it, not on the next report
+    now = datetime.now()
+    state['events'].append((now, message))
+    print(f"[{now:%Y-%m-%d %H:%M:%S}] {message}")
+
+class HeartbeatRecorder(monitoring.ServerHeartbeatListener):
+    def __init__(self, state):
+        self.state = state
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self.state['lock']:
+            member = sdam_member(self.state, event.connection_id)
+            member['last_success'] = time.time()
+            member['last_failure'] = None
+            # Awaited (streaming) heartbeats last as long as the server holds them, they are not round trips
+            if not event.awaited:
+                rtt = event.duration * 1000
+                member['last_rtt'] = rtt
+                member['rtt'][bisect_left(RTT_BUCKETS, rtt)] += 1
+
+    def failed(self, event):
+        with self.state['lock']:
+            member = sdam_member(self.state, event.connection_id)
+            member['failures'] += 1
+            member['last_failure'] = str(event.reply)
+
+class TopologyRecorder(monitoring.TopologyListener):
+    def __init__(self, state):
+        self.state = state
+
+    def opened(self, event):
+        pass
+
+    def closed(self, event):
+        pass
+
+    def description_changed(self, event):
+        previous = event.previous_description.server_descriptions()
+        new = event.new_description.server_descriptions()
+        with self.state['lock']:
+            for address, description in new.items():
+                member = sdam_member(self.state, address)
+                member['state'] = MEMBER_STATES.get(description.server_type_name, description.server_type_name)
+                member['set'] = description.replica_set_name or member['set']
+                before = previous.get(address)
+                # Unknown is where every member starts, leaving it is discovery and not a state change
+                if before and before.server_type_name not in ('Unknown', description.server_type_name):
+                    sdam_event(self.state, f"Member {member_name(address)} changed from {MEMBER_STATES.get(before.server_type_name, before.server_type_name)} to {member['state']}")
+
+            if event.previous_description.topology_type_name == 'Unknown':
+                return
+            old_primary = next((description for description in previous.values() if description.server_type_name == 'RSPrimary'), None)
+            new_primary = next((description for description in new.values() if description.server_type_name == 'RSPrimary'), None)
+            new_primary_before = previous.get(new_primary.address) if new_primary else None
+            set_name = event.new_description.replica_set_name
+            if old_primary and not new_primary:
+                sdam_event(self.state, f"Replica set {set_name} lost its primary {member_name(old_primary.address)}, election in progress")
+            elif new_primary and not old_primary and new_primary_before and new_primary_before.server_type_name != 'Unknown':
+                sdam_event(self.state, f"Replica set {set_name} elected {member_name(new_primary.address)} as primary")
+            elif old_primary and new_primary and old_primary.address != new_primary.address:
+                sdam_event(self.state, f"Replica set {set_name} failed over from {member_name(old_primary.address)} to {member_name(new_primary.address)}")
+            elif old_primary and new_primary and old_primary.election_id != new_primary.election_id:
+                sdam_event(self.state, f"Replica set {set_name} re-elected {member_name(new_primary.address)} (electionId {new_primary.election_id})")
+
+def member_name(address):
+    return f"{address[0]}:{address[1]}"
+
+def rtt_percentile(histogram, fraction):
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(RTT_BUCKETS, histogram):
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return RTT_BUCKETS[-1]
+
+def sdam_heartbeat_info(state):
+    # Same shape as the replSetGetStatus based report, so analyze_heartbeat_info applies unchanged
+    heartbeat_info = {}
+    with state['lock']:
+        for name, member in state['members'].items():
+            last_success = datetime.fromtimestamp(member['last_success']) if member['last_success'] else 'N/A'
+            heartbeat_info[name] = {
+                'set': member['set'],
+                'state': member['state'],
+                'health': 1.0 if member['last_success'] and not member['last_failure'] else 0.0,
+                'lastHeartbeat': last_success,
+                'lastHeartbeatRecv': last_success,
+                'lastHeartbeatMessage': member['last_failure'] or 'N/A',
+                'failures': member['failures'],
+                'rttMs': None if member['last_rtt'] is None else round(member['last_rtt'], 2)
+            }
+    return heartbeat_info
+
+def rtt_label(bound):
+    return f"<={bound}ms" if bound != float('inf') else f">{RTT_BUCKETS[-2]}ms"
+
+def print_rtt_histograms(state):
+    labels = [rtt_label(bound) for bound in RTT_BUCKETS]
+    print("\nHeartbeat round trip times:")
+    with state['lock']:
+        for name, member in sorted(state['members'].items()):
+            if not any(member['rtt']):
+                print(f"  {name}  no successful heartbeats")
+                continue
+            buckets = '  '.join(f"{label}: {count}" for label, count in zip(labels, member['rtt']) if count)
+            print(f"  {name}  p50 {rtt_label(rtt_percentile(member['rtt'], 0.5))}  p99 {rtt_label(rtt_percentile(member['rtt'], 0.99))}  {buckets}")
+
+def print_sdam_report(state, analyze_heartbeat_info):
+    heartbeat_info = sdam_heartbeat_info(state)
+    print("\nReplication heartbeat information:")
+    for member, info in heartbeat_info.items():
+        print(f"\nMember: {member}")
+        for key, value in info.items():
+            print(f"  {key}: {value}")
+    print_rtt_histograms(state)
+    with state['lock']:
+        events = list(state['events'])
+    if events:
+        print(f"\nLast {len(events)} topology events:")
+        for ts, message in events:
+            print(f"  [{ts:%Y-%m-%d %H:%M:%S}] {message}")
+    issues = analyze_heartbeat_info(heartbeat_info)
+    if issues:
+        print("\nIssues found with heartbeat:")
+        for issue in issues:
+            print(f"- {issue}")
+    else:
+        print("\nNo issues found with heartbeat.")
+
+def sdam_client(hosts, state, args, **kwargs):
+    # Poll mode makes every heartbeat a real round trip, the driver sends them anyway
+    if pymongo.version_tuple < (4, 7):
+        raise SystemExit(f"--sdam needs PyMongo 4.7 or later for serverMonitoringMode, found {pymongo.version}")
+    return MongoClient(hosts, event_listeners=[HeartbeatRecorder(state), TopologyRecorder(state)],
+                       heartbeatFrequencyMS=int(args.heartbeat_frequency * 1000), serverMonitoringMode='poll', **kwargs)
+
+def run_sdam_monitor(state, args, analyze_heartbeat_info):
+    started = time.time()
+    try:
+        while True:
+            remaining = args.duration - (time.time() - started) if args.duration else args.report_interval
+            if remaining <= 0:
+                break
+            time.sleep(min(args.report_interval, remaining))
+            print_sdam_report(state, analyze_heartbeat_info)
+    except KeyboardInterrupt:
+        pass
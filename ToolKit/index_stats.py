@@ -0,0 +1,88 @@
+# Cluster-wide $indexStats collection shared by bt-mongodb-index-profiler and bt-mongodb-index-usage
+
+import sys
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+def get_replica_set_seeds(client):
+    is_master = client.admin.command('isMaster')
+    if is_master.get('msg') == 'isdbgrid':
+        seeds = []
+        for shard in client.admin.command('listShards')['shards']:
+            set_name, _, hosts = shard['host'].rpartition('/')
+            seeds.append((set_name or shard['_id'], hosts.split(',')[0]))
+        return seeds
+    if 'setName' in is_master:
+        return [(is_master['setName'], is_master.get('primary') or is_master['me'])]
+    return []
+
+def get_node_clients(client, args, **kwargs):
+    # $indexStats counters are per mongod and reset on restart, so every data bearing member is asked
+    seeds = get_replica_set_seeds(client)
+    if not seeds:
+        # Standalone server, its own counters are the whole picture
+        name = f"{args.host}:{args.port}"
+        return {name: client}, {name: None}
+
+    node_clients = {}
+    node_sets = {}
+    for set_name, seed in seeds:
+        seed_client = MongoClient(seed, username=args.user, password=args.password, directConnection=True)
+        try:
+            members = [member['name'] for member in seed_client.admin.command('replSetGetStatus')['members']
+                       if member.get('stateStr') in ('PRIMARY', 'SECONDARY')]
+        except PyMongoError as e:
+            print(f"Error getting replica set members from {seed}: {e}", file=sys.stderr)
+            members = [seed]
+        finally:
+            seed_client.close()
+        for member in members:
+            node_clients[member] = MongoClient(member, username=args.user, password=args.password, directConnection=True, **kwargs)
+            node_sets[member] = set_name
+    return node_clients, node_sets
+
+def fetch_index_stats(name, node_client, db_name, coll_name):
+    # None is a node that failed, an empty list a node that answered without rows
+    try:
+        return list(node_client[db_name][coll_name].aggregate([{'$indexStats': {}}]))
+    except PyMongoError as e:
+        print(f"Error running $indexStats on {name}: {e}", file=sys.stderr)
+        return None
+
+def fetch_all_nodes(node_clients, pool, db_name, coll_name):
+    names = list(node_clients)
+    return dict(zip(names, pool.map(lambda name: fetch_index_stats(name, node_clients[name], db_name, coll_name), names)))
+
+def merge_index_stats(node_stats, node_sets):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    merged = {}
+    for name, index_stats in node_stats.items():
+        for doc in index_stats or []:
+            accesses = doc.get('accesses', {})
+            since = accesses.get('since')
+            observed = now - since if isinstance(since, datetime) else timedelta(0)
+            entry = merged.setdefault(doc.get('name', ''), {'key': doc.get('key', ''), 'ops': 0, 'nodes': 0, 'observed': observed, 'sets': set()})
+            entry['ops'] += accesses.get('ops', 0)
+            entry['nodes'] += 1
+            entry['observed'] = min(entry['observed'], observed)
+            entry['sets'].add(node_sets[name])
+
+    # Shards without the collection answer with no rows, only the replica sets that hold the index have to answer.
+    # A replica set where no member answered may hold it too.
+    silent_sets = {set_name for set_name in node_sets.values()
+                   if all(node_stats.get(member) is None for member, member_set in node_sets.items() if member_set == set_name)}
+    for entry in merged.values():
+        sets = entry.pop('sets') | silent_sets
+        entry['unreachable'] = sum(1 for member, set_name in node_sets.items() if set_name in sets and node_stats.get(member) is None)
+    return merged
+
+def index_status(entry, min_window):
+    # Zero ops only means unused once every member holding the index answered and watched it long enough
+    if entry['ops']:
+        return 'used'
+    if entry['unreachable']:
+        return 'unknown'
+    if entry['observed'] >= min_window:
+        return 'unused'
+    return 'too recent'